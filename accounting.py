@@ -0,0 +1,100 @@
+# Resource accounting for finished jobs and right-sizing of new requests.
+#
+# The usage of our finished jobs is pulled from sacct and matched with the
+# metadata.json that hpc_service leaves in each job directory so we know
+# what the job was for and what was predicted.  The records are kept in
+# accounting.json in the batch directory and the recommender uses their
+# percentiles to size the ram, cpus and walltime of new jobs.
+import json
+import logging
+from math import ceil
+from pathlib import Path
+import time
+
+from slurm import Slurm, parse_duration
+from costmodel import quantile
+
+
+class Accounting:
+    def __init__(self, slurm: Slurm, dbfile=None):
+        self.slurm = slurm
+        self.dbfile = Path(dbfile) if dbfile else slurm.batchdir / "accounting.json"
+        self.records = {}
+        if self.dbfile.exists():
+            with open(self.dbfile) as f:
+                self.records = json.load(f)
+
+
+    def save(self):
+        tmpfile = self.dbfile.with_name(self.dbfile.name + ".tmp")
+        with open(tmpfile, "w") as f:
+            json.dump(self.records, f, indent=2)
+        tmpfile.replace(self.dbfile)
+
+
+    def refresh(self, days=7):
+        """Pull the accounting for our finished jobs and store the new ones"""
+        count = 0
+        for jobid, rec in self.slurm.get_accounting(days).items():
+            if jobid in self.records or not rec['name'].startswith("job-"):
+                continue
+            if rec['job_state'] not in ('COMPLETED', 'TIMEOUT', 'OUT_OF_MEMORY', 'FAILED'):
+                # still running or cancelled, which doesn't say much about usage
+                continue
+            metadata = self._metadata(rec['name'], jobid)
+            if metadata is None:
+                continue
+            elapsed = parse_duration(rec['elapsed']) or 0
+            self.records[jobid] = {
+                'name': rec['name'],
+                'state': rec['job_state'],
+                'elapsed': elapsed,
+                'time_limit': parse_duration(rec['time_limit']),
+                'total_cpu': parse_duration(rec['total_cpu']) or 0,
+                'max_rss': rec['max_rss'],
+                'cpus': int(rec['cpus'] or 0),
+                'recorded': time.time(),
+                **metadata,
+            }
+            count += 1
+        if count:
+            self.save()
+        logging.info(f"Recorded accounting for {count} new jobs, {len(self.records)} total")
+        return count
+
+
+    def _metadata(self, job_name, jobid):
+        """Get the metadata that was saved when the job was submitted"""
+        mfile = self.slurm.batchdir / job_name / "metadata.json"
+        if not mfile.exists():
+            return None
+        with open(mfile) as f:
+            metadata = json.load(f)
+        if "_" in jobid:
+            # array tasks have their own metadata
+            metadata = metadata.get(jobid.split("_")[1], None)
+        return metadata
+
+
+    def recommend(self, key: str, slots: int, predicted: float, percentile=0.95, margin=0.1, min_samples=5):
+        """Recommend the ram (GB), cpus and walltime (minutes) for a job
+           with the given number of slots and predicted makespan, based on
+           the usage of previous jobs with the same key.  Returns None if
+           there isn't enough history."""
+        recs = [r for r in self.records.values() if r.get('key') == key and r.get('slots')]
+        if len(recs) < min_samples:
+            return None
+
+        ram = sorted(r['max_rss'] / r['slots'] for r in recs)
+        cpus = sorted(r['total_cpu'] / r['elapsed'] / r['slots'] for r in recs if r['elapsed'] > 0)
+        # jobs which ran out of time don't tell us how long they needed, but
+        # they do tell us that we needed more than the limit.
+        ratio = sorted((r['elapsed'] if r['state'] != 'TIMEOUT' else r['elapsed'] * 1.5) / r['predicted']
+                       for r in recs if r.get('predicted'))
+        res = {
+            'ram': ceil(quantile(ram, percentile) * slots * (1 + margin)),
+            'cpus': max(1, ceil(quantile(cpus, percentile) * slots * (1 + margin))) if cpus else None,
+            'job_time': ceil(quantile(ratio, percentile) * predicted * (1 + margin) / 60) if ratio else None,
+            'samples': len(recs),
+        }
+        return res
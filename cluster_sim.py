@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# Discrete event simulation of a plan running on a cluster.
+#
+# This is used to compare planner policies and settings offline.  The plans
+# come from `hpc_service.py plan` and the cluster is described by the number
+# of GPU and CPU nodes, what each node has, and a queue wait distribution.
+#
+#   cluster_sim.py synth --count 100000 > request.json
+#   hpc_service.py plan < request.json > plan.json
+#   cluster_sim.py simulate plan.json --gpu-nodes 8 --queue-wait exp:1800
+#   cluster_sim.py compare request.json --planner lpt greedy --max-slot-target 3600 10800
+import argparse
+import configparser
+import heapq
+import json
+import logging
+from pathlib import Path
+import random
+import sys
+
+
+class Cluster:
+    """The description of the cluster being simulated"""
+    def __init__(self, gpu_nodes=8, cpu_nodes=32, gpus_per_node=4, cpus_per_node=128,
+                 ram_per_node=256, queue_wait="exp:600", runtime_sigma=0.1, startup=60):
+        self.nodes = []
+        for n in range(gpu_nodes):
+            self.nodes.append({'name': f"gpu{n}", 'gpus': gpus_per_node, 'cpus': cpus_per_node, 'ram': ram_per_node})
+        for n in range(cpu_nodes):
+            self.nodes.append({'name': f"cpu{n}", 'gpus': 0, 'cpus': cpus_per_node, 'ram': ram_per_node})
+        self.queue_wait = queue_wait
+        self.runtime_sigma = runtime_sigma
+        # time before the first file starts:  apptainer, imports, model loading
+        self.startup = startup
+
+
+    def sample_wait(self, rng: random.Random):
+        """Sample the queue wait distribution, which is one of:
+           fixed:<seconds>, exp:<mean>, lognormal:<mu>:<sigma>, or
+           empirical:<file with one wait per line>"""
+        kind, _, args = self.queue_wait.partition(":")
+        if kind == "fixed":
+            return float(args)
+        elif kind == "exp":
+            return rng.expovariate(1 / float(args)) if float(args) > 0 else 0
+        elif kind == "lognormal":
+            mu, sigma = [float(x) for x in args.split(":")]
+            return rng.lognormvariate(mu, sigma)
+        elif kind == "empirical":
+            if not hasattr(self, '_empirical'):
+                self._empirical = [float(x) for x in Path(args).read_text().split()]
+            return rng.choice(self._empirical)
+        raise ValueError(f"Unknown queue wait distribution: {self.queue_wait}")
+
+
+def simulate(plan: dict, cluster: Cluster, seed=0):
+    """Run the jobs in the plan on the cluster.  All of the jobs are
+       submitted at time 0 and become eligible after their queue wait.
+       Eligible jobs are started in eligibility order on the first node
+       with enough free resources, and smaller jobs may start ahead of
+       larger ones that don't fit."""
+    rng = random.Random(seed)
+    free = [dict(n) for n in cluster.nodes]
+    events = []
+    seq = 0
+    for n, j in enumerate(plan['jobs']):
+        heapq.heappush(events, (cluster.sample_wait(rng), seq, 'eligible', n))
+        seq += 1
+
+    waiting = []
+    results = [None] * len(plan['jobs'])
+    t = 0.0
+    while events:
+        t, _, kind, n = heapq.heappop(events)
+        job = plan['jobs'][n]
+        if kind == 'eligible':
+            waiting.append(n)
+        elif kind == 'end':
+            node = free[results[n]['node']]
+            node['gpus'] += job['gpus']
+            node['cpus'] += job['cpus']
+            node['ram'] += job['ram']
+
+        # start anything that fits
+        for n in list(waiting):
+            job = plan['jobs'][n]
+            for i, node in enumerate(free):
+                if node['gpus'] >= job['gpus'] and node['cpus'] >= job['cpus'] and node['ram'] >= job['ram'] and \
+                   (job['gpus'] > 0 or cluster.nodes[i]['gpus'] == 0):
+                    node['gpus'] -= job['gpus']
+                    node['cpus'] -= job['cpus']
+                    node['ram'] -= job['ram']
+                    waiting.remove(n)
+                    runtime = cluster.startup + job['makespan'] * rng.lognormvariate(0, cluster.runtime_sigma)
+                    limit = job['job_time'] * 60
+                    results[n] = {'node': i, 'start': t, 'runtime': min(runtime, limit),
+                                  'end': t + min(runtime, limit), 'timeout': runtime > limit}
+                    heapq.heappush(events, (t + min(runtime, limit), seq, 'end', n))
+                    seq += 1
+                    break
+
+    if waiting:
+        raise ValueError(f"{len(waiting)} jobs can never run on this cluster")
+
+    waits = [r['start'] for r in results]
+    return {
+        'jobs': len(results),
+        'makespan': max([r['end'] for r in results], default=0),
+        'mean_queue_wait': sum(waits) / len(waits) if waits else 0,
+        'max_queue_wait': max(waits, default=0),
+        'requested_hours': sum(j['job_time'] / 60 for j in plan['jobs']),
+        'used_hours': sum(r['runtime'] for r in results) / 3600,
+        'timeouts': sum(1 for r in results if r['timeout']),
+    }
+
+
+def synth_request(count, mean_duration=1800, video_fraction=0.3, params=None, seed=0):
+    """Generate a synthetic submission with exponentially distributed
+       durations"""
+    rng = random.Random(seed)
+    request = {
+        'function': 'whisper',
+        'params': params or {'engine': 'faster_whisper', 'model': 'medium', 'language': 'en',
+                             'device': 'cuda', 'vad': False},
+        'tasklist': [],
+        'probes': {},
+        'email': None,
+        'scphost': 'localhost',
+        'scpuser': 'nobody',
+    }
+    for n in range(count):
+        infile = f"/synthetic/{n:06d}.mp4"
+        request['tasklist'].append({'infile': infile, 'outfile': infile + ".whisper.json"})
+        request['probes'][infile] = {
+            'format': {'duration': rng.expovariate(1 / mean_duration)},
+            '_stream_types': {'audio': 1, 'video': 1} if rng.random() < video_fraction else {'audio': 1}
+        }
+    return request
+
+
+def probe_request(directory: Path, params=None):
+    """Build a submission from a directory of historical .probe files"""
+    request = synth_request(0, params=params)
+    for f in sorted(directory.glob("**/*.probe")):
+        with open(f) as pf:
+            probe = json.load(pf)
+        infile = str(f.with_suffix(''))
+        stream_types = {}
+        for s in probe['streams']:
+            stream_types[s['codec_type']] = stream_types.get(s['codec_type'], 0) + 1
+        request['tasklist'].append({'infile': infile, 'outfile': infile + ".whisper.json"})
+        request['probes'][infile] = {'format': {'duration': probe['format'].get('duration', 0)},
+                                     '_stream_types': stream_types}
+    return request
+
+
+def add_cluster_args(parser):
+    parser.add_argument("--gpu-nodes", type=int, default=8, help="Number of GPU nodes")
+    parser.add_argument("--cpu-nodes", type=int, default=32, help="Number of CPU nodes")
+    parser.add_argument("--gpus-per-node", type=int, default=4, help="GPUs per node")
+    parser.add_argument("--cpus-per-node", type=int, default=128, help="CPUs per node")
+    parser.add_argument("--ram-per-node", type=int, default=256, help="GB RAM per node")
+    parser.add_argument("--queue-wait", default="exp:600", help="Queue wait distribution")
+    parser.add_argument("--runtime-sigma", type=float, default=0.1, help="Lognormal runtime noise")
+    parser.add_argument("--startup", type=float, default=60, help="Job startup seconds")
+    parser.add_argument("--runs", type=int, default=5, help="Number of runs to average")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+
+
+def cluster_from_args(args):
+    return Cluster(args.gpu_nodes, args.cpu_nodes, args.gpus_per_node, args.cpus_per_node,
+                   args.ram_per_node, args.queue_wait, args.runtime_sigma, args.startup)
+
+
+def simulate_runs(plan, cluster, runs, seed):
+    """Average the results of several simulation runs"""
+    results = [simulate(plan, cluster, seed + n) for n in range(runs)]
+    return {k: sum(r[k] for r in results) / len(results) for k in results[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--debug", default=False, action="store_true", help="Turn on debugging")
+    subparsers = parser.add_subparsers(help="Command", dest='command', required=True)
+    sp = subparsers.add_parser('synth', help="Generate a synthetic request")
+    sp.add_argument("--count", type=int, default=1000, help="Number of files")
+    sp.add_argument("--mean-duration", type=float, default=1800, help="Mean file duration")
+    sp.add_argument("--video-fraction", type=float, default=0.3, help="Fraction of files which are video")
+    sp.add_argument("--from-probes", type=Path, help="Use the .probe files in a directory instead")
+    sp.add_argument("--seed", type=int, default=0, help="Random seed")
+    sp = subparsers.add_parser('simulate', help="Simulate a plan")
+    sp.add_argument("plan", type=Path, help="Plan from hpc_service.py plan")
+    add_cluster_args(sp)
+    sp = subparsers.add_parser('compare', help="Compare planner settings for a request")
+    sp.add_argument("request", type=Path, help="Request file")
+    sp.add_argument("--config", type=str, default=sys.path[0] + "/hpc_batch.ini", help="hpc_service config file")
+    sp.add_argument("--planner", nargs="+", default=[None], help="Planner policies")
+    sp.add_argument("--max-slot-target", type=int, nargs="+", default=[None], help="Slot targets")
+    sp.add_argument("--concurrent-batches", type=int, nargs="+", default=[None], help="Concurrent batches")
+    add_cluster_args(sp)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING,
+                        format="%(asctime)s [%(process)d:%(filename)s:%(lineno)d] [%(levelname)s] %(message)s")
+
+    if args.command == "synth":
+        if args.from_probes:
+            request = probe_request(args.from_probes)
+        else:
+            request = synth_request(args.count, args.mean_duration, args.video_fraction, seed=args.seed)
+        json.dump(request, sys.stdout)
+    elif args.command == "simulate":
+        with open(args.plan) as f:
+            plan = json.load(f)
+        print(json.dumps(simulate_runs(plan, cluster_from_args(args), args.runs, args.seed), indent=4))
+    elif args.command == "compare":
+        from hpc_service import plan_whisper
+        config = configparser.ConfigParser()
+        config.read(args.config)
+        with open(args.request) as f:
+            request = json.load(f)
+        cluster = cluster_from_args(args)
+        print(f"{'planner':8s} {'slot':>6s} {'conc':>4s} {'jobs':>6s} {'predicted':>10s} {'simulated':>10s} {'wait':>8s} {'req hrs':>9s} {'used hrs':>9s} {'timeouts':>8s}")
+        for policy in args.planner:
+            for slot in args.max_slot_target:
+                for conc in args.concurrent_batches:
+                    overrides = {k: v for k, v in (('planner', policy), ('max_slot_target', slot),
+                                                   ('concurrent_batches', conc)) if v is not None}
+                    plan = plan_whisper(json.loads(json.dumps(request)), config, overrides)
+                    r = simulate_runs(plan, cluster, args.runs, args.seed)
+                    print(f"{plan['planner']:8s} {plan['max_slot_target']:6d} {plan['concurrent_batches']:4d} {len(plan['jobs']):6d} "
+                          f"{plan['makespan']:10.0f} {r['makespan']:10.0f} {r['mean_queue_wait']:8.0f} "
+                          f"{r['requested_hours']:9.1f} {r['used_hours']:9.1f} {r['timeouts']:8.1f}")
+
+
+if __name__ == "__main__":
+    main()
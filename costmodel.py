@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# Runtime cost model learned from previous transcription runs.
+#
+# Every transcript written by hpc_whisper_server has a _job record with the
+# runtime, media duration and the job parameters, and the Performance files
+# from mdpi_metadata_generator have whisper-transcribe checkpoints.  The
+# ratio of processing seconds to content seconds is collected for each
+# (engine, model, device, vad, media type) and the quantiles of that ratio
+# are used to predict how long a file will take.  Batched faster_whisper runs
+# are kept apart from the unbatched ones by the batch size on the model, and
+# runs which skipped the silences (whose ratio is per speech second) are
+# kept apart from the ones which didn't.
+import argparse
+import json
+import logging
+from pathlib import Path
+import sys
+
+# the quantiles which are computed when the model is fit.
+QUANTILES = (0.5, 0.9, 0.95)
+
+
+def model_key(engine, model, device, vad, media_type, batch_size=1, skip_silence=False):
+    """Create the key used to store samples"""
+    if batch_size > 1:
+        model = f"{model}@b{batch_size}"
+    if skip_silence:
+        model = f"{model}@speech"
+    return "/".join([str(engine), str(model), str(device), 'vad' if vad else 'novad', str(media_type)])
+
+
+def media_type_of(stream_types: dict):
+    """Determine the media type from the ffprobe _stream_types"""
+    return 'video' if 'video' in stream_types else 'audio'
+
+
+def quantile(values: list[float], q: float):
+    """Linear interpolated quantile of sorted values"""
+    if not values:
+        return None
+    pos = (len(values) - 1) * q
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+class CostModel:
+    def __init__(self, data=None):
+        data = data or {}
+        # key -> list of processing seconds per content second
+        self.samples = data.get('samples', {})
+        # key -> {'count': n, 'mean': x, 'p50': x, ...}
+        self.stats = data.get('stats', {})
+        # which files have already been ingested so they aren't counted twice.
+        self.seen = set(data.get('seen', []))
+
+
+    @classmethod
+    def load(cls, filename):
+        """Load a model from disk, returning an empty model if it doesn't exist"""
+        filename = Path(filename)
+        if not filename.exists():
+            logging.debug(f"Cost model {filename} doesn't exist, using an empty model")
+            return cls()
+        with open(filename) as f:
+            return cls(json.load(f))
+
+
+    def save(self, filename):
+        """Save the model to disk"""
+        with open(filename, "w") as f:
+            json.dump({'samples': self.samples,
+                       'stats': self.stats,
+                       'seen': sorted(self.seen)}, f, indent=2)
+
+
+    def add_sample(self, engine, model, device, vad, media_type, content_time, runtime, batch_size=1, skip_silence=False):
+        """Add a single observation"""
+        if content_time <= 0 or runtime <= 0:
+            return
+        key = model_key(engine, model, device, vad, media_type, batch_size, skip_silence)
+        if key not in self.samples:
+            self.samples[key] = []
+        self.samples[key].append(runtime / content_time)
+
+
+    def ingest_transcript(self, filename: Path):
+        """Ingest the _job record from a transcript file"""
+        with open(filename) as f:
+            data = json.load(f)
+        if '_job' not in data:
+            logging.debug(f"{filename} doesn't have a _job record")
+            return 0
+        job = data['_job']
+        ident = f"{job.get('job_id')}:{job.get('infile')}:{job.get('outfile')}"
+        if ident in self.seen:
+            return 0
+        self.seen.add(ident)
+        params = job['params']
+        self.add_sample(params['engine'], params['model'], job.get('device', params['device']),
+                        params.get('vad', False), job.get('media_type', 'unknown'),
+                        job.get('speech_duration', job['media_duration']), job['runtime'], params.get('batch_size', 1),
+                        'speech_duration' in job)
+        return 1
+
+
+    def ingest_perf(self, filename: Path):
+        """Ingest the whisper-transcribe checkpoints from a Performance file"""
+        with open(filename) as f:
+            data = json.load(f)
+        # the whisper-load-model checkpoint has the device for the process,
+        # but the merged file doesn't keep the processes separate so use the
+        # first one.
+        device = 'unknown'
+        for entry in data.get('whisper-load-model', []):
+            device = entry[4]
+            break
+        count = 0
+        for entry in data.get('whisper-transcribe', []):
+            start, _, runtime, model, afile, duration = entry[:6]
+            ident = f"perf:{afile}:{start}"
+            if ident in self.seen:
+                continue
+            self.seen.add(ident)
+            self.add_sample('whisper', model, device, False, 'unknown', float(duration), runtime)
+            count += 1
+        return count
+
+
+    def fit(self, min_samples=5):
+        """Compute the statistics for each key.  Samples are also pooled
+           across media types so there's a fallback when a specific media
+           type hasn't been seen."""
+        pooled = {}
+        for key, values in self.samples.items():
+            pooled.setdefault(key, []).extend(values)
+            pooled.setdefault(key.rsplit("/", 1)[0] + "/*", []).extend(values)
+        self.stats = {}
+        for key, values in pooled.items():
+            if len(values) < min_samples:
+                continue
+            values = sorted(values)
+            stats = {'count': len(values),
+                     'mean': sum(values) / len(values)}
+            for q in QUANTILES:
+                stats[f"p{int(q * 100)}"] = quantile(values, q)
+            self.stats[key] = stats
+        return self.stats
+
+
+    def lookup(self, params: dict, media_type: str):
+        """Find the stats for the parameters, falling back to the pooled
+           media types if needed"""
+        key = model_key(params['engine'], params['model'], params['device'], params.get('vad', False), media_type,
+                        params.get('batch_size', 1), bool(params.get('skip_silence')))
+        if key in self.stats:
+            return self.stats[key]
+        return self.stats.get(key.rsplit("/", 1)[0] + "/*", None)
+
+
+    def predict(self, params: dict, media_type: str, duration: float, stat="mean"):
+        """Predict the processing time for content, or None if the model
+           doesn't know about these parameters"""
+        stats = self.lookup(params, media_type)
+        if stats is None:
+            return None
+        return duration * stats[stat]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--debug", default=False, action="store_true", help="Turn on debugging")
+    parser.add_argument("--min-samples", type=int, default=5, help="Minimum samples for a prediction")
+    parser.add_argument("model", type=Path, help="Cost model file to update")
+    parser.add_argument("src", nargs="*", type=Path, help="Transcripts, .perf files, or directories of them")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format="%(asctime)s [%(process)d:%(filename)s:%(lineno)d] [%(levelname)s] %(message)s")
+
+    cm = CostModel.load(args.model)
+    sources = []
+    for s in args.src:
+        if s.is_dir():
+            sources.extend(s.glob("**/*.whisper.json"))
+            sources.extend(s.glob("**/*.perf"))
+        else:
+            sources.append(s)
+
+    count = 0
+    for s in sources:
+        try:
+            if s.name.endswith(".perf"):
+                count += cm.ingest_perf(s)
+            else:
+                count += cm.ingest_transcript(s)
+        except Exception as e:
+            logging.warning(f"Cannot ingest {s}: {e}")
+    logging.info(f"Ingested {count} new samples from {len(sources)} files")
+
+    for key, stats in sorted(cm.fit(args.min_samples).items()):
+        print(f"{key:45s} n={stats['count']:<6d} mean={stats['mean']:0.4f} p50={stats['p50']:0.4f} p95={stats['p95']:0.4f}", file=sys.stderr)
+    cm.save(args.model)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# Fake sbatch/squeue/sacct/scancel/sinfo for testing without a cluster.
+#
+# Install it with:
+#    fake_slurm.py install <bindir>
+# which creates sbatch, squeue, sacct, scancel and sinfo links in bindir.  Setting
+# slurm_bin=<bindir> in hpc_batch.ini points Slurm at them.
+#
+# Nothing is ever run:  the jobs are just records in a state file which
+# move from PENDING to RUNNING to COMPLETED based on the wall clock.  The
+# behavior is controlled by environment variables:
+#   FAKE_SLURM_STATE       state directory (default /tmp/fake_slurm-<user>)
+#   FAKE_SLURM_QUEUE_WAIT  mean queue wait in seconds, exponential (default 5)
+#   FAKE_SLURM_RUNTIME     fraction of the walltime a job runs (default 0.5)
+#   FAKE_SLURM_TIMESCALE   simulated seconds per real second (default 1)
+#   FAKE_SLURM_IDLE_NODES  idle nodes reported by sinfo (default 2)
+import fcntl
+import getpass
+import json
+import os
+from pathlib import Path
+import random
+import sys
+import time
+
+COMMANDS = ('sbatch', 'squeue', 'sacct', 'scancel', 'sinfo')
+
+
+def state_dir():
+    d = Path(os.environ.get('FAKE_SLURM_STATE', f"/tmp/fake_slurm-{getpass.getuser()}"))
+    d.mkdir(exist_ok=True, parents=True)
+    return d
+
+
+class State:
+    """The job database, locked for the duration of the command"""
+    def __enter__(self):
+        self.lock = open(state_dir() / "lock", "w")
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        try:
+            with open(state_dir() / "jobs.json") as f:
+                self.data = json.load(f)
+        except FileNotFoundError:
+            self.data = {'next_id': 1000, 'jobs': {}}
+        return self
+
+
+    def __exit__(self, *args):
+        with open(state_dir() / "jobs.json", "w") as f:
+            json.dump(self.data, f, indent=2)
+        self.lock.close()
+
+
+def now():
+    """The simulated time"""
+    return time.time() * float(os.environ.get('FAKE_SLURM_TIMESCALE', 1))
+
+
+def parse_time(t: str):
+    """Convert a slurm time limit to seconds"""
+    days = 0
+    if "-" in t:
+        d, t = t.split("-", 1)
+        days = int(d)
+        parts = [int(x) for x in t.split(":")]
+        while len(parts) < 3:
+            parts.append(0)
+        return days * 86400 + parts[0] * 3600 + parts[1] * 60 + parts[2]
+    parts = [int(x) for x in t.split(":")]
+    if len(parts) == 1:
+        return parts[0] * 60
+    elif len(parts) == 2:
+        return parts[0] * 60 + parts[1]
+    return parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+
+def format_time(s: float):
+    s = int(s)
+    return f"{s // 3600}:{(s // 60) % 60:02d}:{s % 60:02d}"
+
+
+def iso(t):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(t / float(os.environ.get('FAKE_SLURM_TIMESCALE', 1))))
+
+
+def job_state(job):
+    """Determine the state of a job at the current time"""
+    if job.get('cancelled'):
+        return 'CANCELLED'
+    t = now()
+    if t < job['start']:
+        return 'PENDING'
+    if t < job['end']:
+        return 'RUNNING'
+    return 'COMPLETED' if job['runtime'] <= job['time_limit'] else 'TIMEOUT'
+
+
+def sbatch(args):
+    script = Path(args[-1])
+    opts = {'-J': script.name, '-t': "1:00", '-p': 'general', '--mincpus': '1', '--mem': '16G', '--array': None}
+    for line in script.read_text().splitlines():
+        if not line.startswith("#SBATCH "):
+            continue
+        parts = line[8:].strip().replace("=", " ", 1).split(None, 1)
+        if parts[0] in opts:
+            opts[parts[0]] = parts[1] if len(parts) > 1 else ""
+    time_limit = parse_time(opts['-t'])
+    runtime = time_limit * float(os.environ.get('FAKE_SLURM_RUNTIME', 0.5))
+    wait = random.expovariate(1 / max(0.001, float(os.environ.get('FAKE_SLURM_QUEUE_WAIT', 5))))
+    submit = now()
+
+    with State() as state:
+        jobid = state.data['next_id']
+        state.data['next_id'] += 1
+        base = {'name': opts['-J'], 'partition': opts['-p'], 'cpus': opts['--mincpus'],
+                'memory': opts['--mem'], 'time_limit': time_limit, 'runtime': runtime,
+                'submit': submit, 'script': str(script.absolute())}
+        if opts['--array'] is None:
+            state.data['jobs'][str(jobid)] = dict(base, start=submit + wait, end=submit + wait + runtime)
+        else:
+            spec, _, throttle = opts['--array'].partition("%")
+            lo, _, hi = spec.partition("-")
+            indexes = range(int(lo), int(hi or lo) + 1)
+            throttle = int(throttle) if throttle else len(indexes)
+            ends = []
+            for n, idx in enumerate(indexes):
+                start = submit + wait
+                if n >= throttle:
+                    start = max(start, ends[n - throttle])
+                ends.append(start + runtime)
+                state.data['jobs'][f"{jobid}_{idx}"] = dict(base, start=start, end=start + runtime)
+    print(f"Submitted batch job {jobid}")
+    return 0
+
+
+def _get_opt(args, names, default=None):
+    for n, a in enumerate(args):
+        for name in names:
+            if a == name and n + 1 < len(args):
+                return args[n + 1]
+            if a.startswith(name + "="):
+                return a[len(name) + 1:]
+    return default
+
+
+def _select(jobs, args):
+    """Select jobs by --jobs, --name, --partition and --states"""
+    ids = _get_opt(args, ['--jobs', '-j'])
+    name = _get_opt(args, ['--name', '-n'])
+    partition = _get_opt(args, ['--partition', '-p'])
+    states = _get_opt(args, ['--states', '-t'])
+    res = {}
+    for k, j in jobs.items():
+        if partition is not None and j['partition'] != partition:
+            continue
+        if states is not None and job_state(j) not in states.split(","):
+            continue
+        if ids is not None and not any(k == i or k.split("_")[0] == i for i in ids.split(",")):
+            continue
+        if name is not None and j['name'] != name:
+            continue
+        res[k] = j
+    return res
+
+
+def squeue(args):
+    fmt = _get_opt(args, ['--format', '-o'], "%i|%j|%T|%M|%l")
+    with State() as state:
+        jobs = _select(state.data['jobs'], args)
+        if _get_opt(args, ['--jobs', '-j']) and not jobs:
+            print("slurm_load_jobs error: Invalid job id specified", file=sys.stderr)
+            return 1
+        for k, j in jobs.items():
+            s = job_state(j)
+            if s not in ('PENDING', 'RUNNING'):
+                continue
+            values = {
+                '%i': k, '%j': j['name'], '%T': s, '%P': j['partition'],
+                '%M': format_time(max(0, now() - j['start'])) if s == 'RUNNING' else "0:00",
+                '%l': format_time(j['time_limit']), '%V': iso(j['submit']),
+                '%S': iso(j['start']), '%R': "(Priority)" if s == 'PENDING' else "fake0001",
+                '%C': j['cpus'], '%m': j['memory'], '%b': "N/A",
+            }
+            line = fmt
+            for code, v in values.items():
+                line = line.replace(code, str(v))
+            print(line)
+    return 0
+
+
+def sacct(args):
+    fields = _get_opt(args, ['--format', '-o'], "JobID,JobName,State").split(",")
+    with State() as state:
+        for k, j in _select(state.data['jobs'], args).items():
+            s = job_state(j)
+            elapsed = max(0, min(now(), j['end'], j.get('cancelled') or now()) - j['start'])
+            values = {
+                'JobID': k, 'JobName': j['name'], 'State': s, 'Partition': j['partition'],
+                'Elapsed': format_time(elapsed), 'Timelimit': format_time(j['time_limit']),
+                'Submit': iso(j['submit']), 'Start': iso(j['start']), 'End': iso(j['end']),
+                'ExitCode': "0:0", 'AllocCPUS': j['cpus'], 'ReqMem': j['memory'],
+                'TotalCPU': format_time(elapsed * int(j['cpus']) / 2), 'MaxRSS': "",
+            }
+            print("|".join(str(values.get(f, "")) for f in fields))
+            if '-X' not in args and s != 'PENDING':
+                # the batch step is where the memory usage shows up
+                values.update({'JobID': f"{k}.batch", 'JobName': "batch", 'MaxRSS': f"{int(j['runtime']) % 7 + 2}G"})
+                print("|".join(str(values.get(f, "")) for f in fields))
+    return 0
+
+
+def scancel(args):
+    with State() as state:
+        for jobid in [a for a in args if not a.startswith("-") and a not in (_get_opt(args, ['-A']),)]:
+            for k, j in state.data['jobs'].items():
+                if (k == jobid or k.split("_")[0] == jobid) and job_state(j) in ('PENDING', 'RUNNING'):
+                    j['cancelled'] = now()
+    return 0
+
+
+def sinfo(args):
+    idle = int(os.environ.get('FAKE_SLURM_IDLE_NODES', 2))
+    print(f"{idle}|idle")
+    print("16|alloc")
+    return 0
+
+
+def main():
+    command = Path(sys.argv[0]).name
+    args = sys.argv[1:]
+    if command not in COMMANDS:
+        if len(args) == 2 and args[0] == "install":
+            bindir = Path(args[1])
+            bindir.mkdir(exist_ok=True, parents=True)
+            for c in COMMANDS:
+                (bindir / c).unlink(missing_ok=True)
+                (bindir / c).symlink_to(Path(__file__).absolute())
+            return 0
+        if not args or args[0] not in COMMANDS:
+            print(f"Usage: {sys.argv[0]} install <bindir> | {{{','.join(COMMANDS)}}} [args...]", file=sys.stderr)
+            return 1
+        command = args.pop(0)
+    return globals()[command](args)
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -1,6 +1,9 @@
 # FFMPEG helpers
 import subprocess
 import json
+import hashlib
+import os
+from pathlib import Path
 
 
 class FFProbe:
@@ -50,3 +53,31 @@ class FFProbe:
         return res
 
 
+# the whisper models all want 16kHz mono
+AUDIO_CODECS = {
+    'flac': ('.16k.flac', ['-c:a', 'flac']),
+    'opus': ('.16k.opus', ['-c:a', 'libopus', '-b:a', '24k']),
+}
+
+
+def extract_audio(filename, codec='flac', cachedir=None):
+    """Extract the audio of a file as 16kHz mono, cached next to the source
+       (or in cachedir if given) and reused as long as it's newer than the
+       source.  Returns the path to the audio file, or None if ffmpeg
+       failed."""
+    filename = Path(filename)
+    suffix, args = AUDIO_CODECS[codec]
+    if cachedir is None:
+        outfile = filename.with_name(filename.name + suffix)
+    else:
+        outfile = Path(cachedir) / (hashlib.sha1(str(filename.absolute()).encode('utf-8')).hexdigest() + suffix)
+    if outfile.exists() and outfile.stat().st_mtime >= filename.stat().st_mtime:
+        return outfile
+    tmpfile = outfile.with_name(f".{outfile.name}.{os.getpid()}{suffix}")
+    p = subprocess.run(['ffmpeg', '-y', '-i', str(filename), '-vn', '-ac', '1', '-ar', '16000', *args, str(tmpfile)],
+                       stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, encoding='utf-8')
+    if p.returncode != 0:
+        tmpfile.unlink(missing_ok=True)
+        return None
+    os.replace(tmpfile, outfile)
+    return outfile
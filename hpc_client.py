@@ -5,16 +5,87 @@ import socket
 import paramiko
 import ffprobe
 import json
+import hashlib
+import tarfile
+from transfer import file_sha256
+from pathlib import Path
+import gzip
+import concurrent.futures
 import argparse
 import logging
+import os
 import sys
 import select
+import shlex
+
+
+def compact_record(task: dict, probe: ffprobe.FFProbe):
+    """The part of a probe the planner needs, for streamed submissions"""
+    if not probe.probed_successfully():
+        return None
+    record = {'infile': task['infile'], 'outfile': task['outfile'],
+              'duration': float(probe.get_duration()), 'streams': probe.get_stream_types()}
+    for k in ('sha256', 'silence', 'staged'):
+        if k in task:
+            record[k] = task[k]
+    return record
+
+
+def extract_audio_tasks(tasklist: list[dict], files: list[str], codec='flac', workers=4, cachedir=None):
+    """Replace the input files with compact 16kHz mono audio extracted from
+       them, since that's all whisper uses.  The audio is cached next to the
+       source (or in cachedir if the source directory isn't writable).  If
+       the audio isn't any smaller than the original (an mp3, say), the
+       original is used.  Returns the new tasklist and files, with the
+       original file in source."""
+    cachedir = Path(cachedir or Path.home() / ".cache/hpc_audio")
+
+    def extract(f):
+        if os.access(Path(f).parent, os.W_OK):
+            audio = ffprobe.extract_audio(f, codec)
+        else:
+            cachedir.mkdir(parents=True, exist_ok=True)
+            audio = ffprobe.extract_audio(f, codec, cachedir)
+        if audio is None:
+            logging.warning(f"Cannot extract the audio from {f}, sending it as is")
+        elif audio.stat().st_size >= Path(f).stat().st_size:
+            return None
+        return audio
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        audio = dict(zip(files, executor.map(extract, files)))
+    logging.info(f"Extracted the audio from {sum(1 for x in audio.values() if x is not None)} of {len(files)} files")
+    res = []
+    for t in tasklist:
+        t = dict(t)
+        if audio.get(t['infile']) is not None:
+            t.update({'source': t['infile'], 'infile': str(audio[t['infile']])})
+        res.append(t)
+    return res, [str(audio[f]) if audio[f] is not None else f for f in files]
+
+
+def silence_tasks(tasklist: list[dict], blankdir: Path):
+    """Add the silences that blankdetection found for each file, from the
+       <file>--blankdetect.json files in blankdir, so they aren't transcribed
+       and the planner doesn't count them."""
+    res = []
+    count = 0
+    for t in tasklist:
+        t = dict(t)
+        bfile = Path(blankdir) / f"{Path(t.get('source', t['infile'])).name}--blankdetect.json"
+        if bfile.exists():
+            with open(bfile) as f:
+                t['silence'] = [[x['start'], x['end']] for x in json.load(f) if x['type'] == 'silence']
+            count += 1
+        res.append(t)
+    logging.info(f"Found the blank detection for {count} of {len(tasklist)} files")
+    return res
 
 
 class HPCClient:
     def __init__(self, connectuser=None, hpchost="bigred200.uits.iu.edu", 
                  scpuser=None, scphost=None, email=None,
-                 hpcscript="iu_hpc_processing/hpc_service.py"):
+                 hpcscript="iu_hpc_processing/hpc_service.py", session=False):
         self.connectuser = getpass.getuser() if not connectuser else connectuser
         self.email = email
         self.scpuser = self.connectuser if not scpuser else scpuser
@@ -31,11 +102,86 @@ class HPCClient:
         self.stdout = ""
         self.stderr = ""
 
+        # a long running "hpc_service.py serve" to send the commands to
+        self.session = None
+        self.next_id = 0
+        self.responses = {}
+        self.listeners = {}
+        if session:
+            self.open_session()
+
+
+    def open_session(self):
+        """Start a remote service session so the commands don't each need
+           a new remote process"""
+        if self.session is None:
+            # the session may sit quietly for a long time while waiting
+            self.client.get_transport().set_keepalive(60)
+            (stdin, stdout, stderr) = self.client.exec_command(f"{self.hpcscript} serve")
+            self.session = {'stdin': stdin, 'stdout': stdout, 'stderr': stderr}
+
+
+    def close_session(self):
+        if self.session is not None:
+            self.session['stdin'].close()
+            self.session['stdout'].channel.recv_exit_status()
+            self._drain_stderr()
+            self.session = None
 
 
-    def _run_remote(self, command, stdin_data=None):
-        (stdin, stdout, stderr) = self.client.exec_command(command)
-        if stdin_data:
+    def _drain_stderr(self):
+        """Pass along whatever the session has logged so far"""
+        channel = self.session['stdout'].channel
+        data = b""
+        while channel.recv_stderr_ready():
+            data += channel.recv_stderr(65536)
+        if data:
+            print(data.decode(errors='replace'), file=sys.stderr, end="")
+        return data.decode(errors='replace')
+
+
+    def _send(self, args: list[str], stdin_data=None):
+        """Send a request to the session without waiting for the response.
+           Returns the request id."""
+        self.next_id += 1
+        req = {'id': self.next_id, 'argv': args}
+        if stdin_data is not None:
+            req['stdin'] = stdin_data if isinstance(stdin_data, str) else json.dumps(stdin_data)
+        self.session['stdin'].write(json.dumps(req) + "\n")
+        self.session['stdin'].flush()
+        return self.next_id
+
+
+    def _receive(self, reqid: int):
+        """Wait for the response to a request, setting stdout and stderr
+           like a remote command would"""
+        while reqid not in self.responses:
+            line = self.session['stdout'].readline()
+            if not line:
+                self.stderr = self._drain_stderr()
+                self.session = None
+                raise Exception(f"Remote session ended unexpectedly.  Stderr: {self.stderr}")
+            res = json.loads(line)
+            if 'event' in res:
+                if res['id'] in self.listeners:
+                    self.listeners[res['id']](res['event'])
+                continue
+            self.responses[res['id']] = res
+        res = self.responses.pop(reqid)
+        self.listeners.pop(reqid, None)
+        self._drain_stderr()
+        self.stdout = res['stdout'] or ""
+        self.stderr = res['error'] or ""
+        if self.stderr:
+            print(self.stderr, file=sys.stderr)
+
+
+    def _run_remote(self, args: list[str], stdin_data=None):
+        if self.session is not None:
+            self._receive(self._send(args, stdin_data))
+            return
+        (stdin, stdout, stderr) = self.client.exec_command(shlex.join([self.hpcscript, *args]))
+        if stdin_data is not None:
             logging.debug(f"Writing data to remote command: {stdin_data}")
             stdin.write(stdin_data if isinstance(stdin_data, str) else json.dumps(stdin_data))
             stdin.close()
@@ -45,32 +191,166 @@ class HPCClient:
         print(self.stderr, file=sys.stderr)   
         
 
-    def submit(self, function: str, params: dict, tasklist: list[dict], files: list[str]):
-        """Build a submission data packet and send it to HPC for later work.  Return the job ids"""
-        # run ffprobe on all of the files.
-        probes = {}
-        for f in files:
-            p = ffprobe.FFProbe(f)
-            if p.probed_successfully():
-                probes[f] = p.probe
+    def submit(self, function: str, params: dict, tasklist: list[dict], files: list[str], stream=False, compress=False,
+               waves=False, probe_workers=8, max_wave_jobs=64, results='push', checksums=False):
+        """Build a submission data packet and send it to HPC for later work.  Return the job ids.
+           The files are probed in parallel.  When stream is set, the
+           submission is sent as json lines with a compact record for each
+           file as soon as it's probed instead of one document with all of
+           the probes, and it can be gzipped.
 
+           When waves is set, the files are submitted in waves as they're
+           probed so the first jobs can be queued while the rest are still
+           being probed.  The first wave is sent as soon as there's enough
+           content to fill one job, and each wave after that is twice as big
+           (up to max_wave_jobs jobs) so there aren't too many small plans.
+
+           The results are sent back over sftp as each file finishes unless
+           results is 'pull', when they're kept on HPC for fetch_results.
+           When checksums is set, the sha256 of each file is sent so the
+           download on HPC can be verified."""
         sub = {
             'function': function,
             'params': params,
-            'tasklist': tasklist,
-            'probes': probes,
             'email': self.email,
             'scphost': self.scphost,
             'scpuser': self.scpuser,
+            'results': results,
         }
-        self._run_remote(f"{self.hpcscript} submit", sub)
+        files = set(files)
+        probed = self._probe([t for t in tasklist if t.get('localfile', t['infile']) in files], probe_workers, checksums)
+        if not waves:
+            return self._submit_probed(sub, probed, stream, compress)
+
+        job_content = self.capacity(function, params)['job_content']
+        jobids = []
+        wave = []
+        seconds = 0
+        wave_jobs = 1
+        for t, p in probed:
+            wave.append((t, p))
+            if p.probed_successfully():
+                seconds += float(p.get_duration())
+            if seconds >= job_content * wave_jobs:
+                logging.info(f"Submitting a wave of {len(wave)} files with {seconds:0.0f} seconds of content")
+                jobids.extend(self._submit_probed(sub, wave, stream, compress))
+                wave = []
+                seconds = 0
+                wave_jobs = min(wave_jobs * 2, max_wave_jobs)
+        if wave:
+            logging.info(f"Submitting the last wave of {len(wave)} files with {seconds:0.0f} seconds of content")
+            jobids.extend(self._submit_probed(sub, wave, stream, compress))
+        return jobids
+
+
+    def _probe(self, tasklist: list[dict], workers: int, checksums=False):
+        """Probe the task input files in a thread pool, yielding (task, probe)
+           pairs as they finish"""
+        def probe(t):
+            if checksums and not t.get('staged'):
+                t['sha256'] = file_sha256(t.get('localfile', t['infile']))
+            return ffprobe.FFProbe(t.get('localfile', t['infile']))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(probe, t): t for t in tasklist}
+            for f in concurrent.futures.as_completed(futures):
+                yield futures[f], f.result()
+
+
+    def _submit_probed(self, sub: dict, probed, stream=False, compress=False):
+        """Submit (task, probe) pairs, returning the job ids"""
+        if stream:
+            self._stream_submit(sub, probed, compress)
+        else:
+            tasks = []
+            probes = {}
+            for t, p in probed:
+                tasks.append(t)
+                if p.probed_successfully():
+                    probes[t['infile']] = p.probe
+            self._run_remote(['submit'], dict(sub, tasklist=tasks, probes=probes))
         if not self.stdout:
             raise Exception(f"Cannot submit.  Stderr: {self.stderr}")        
         return json.loads(self.stdout)        
 
 
+    def _stream_submit(self, sub: dict, probed, compress=False):
+        """Send a json lines submission on its own channel, sending each
+           (task, probe) pair's record as soon as it's available"""
+        (stdin, stdout, stderr) = self.client.exec_command(shlex.join([self.hpcscript, 'submit']))
+        out = gzip.GzipFile(fileobj=stdin, mode="wb") if compress else stdin
+        out.write((json.dumps(dict(sub, format='jsonl')) + "\n").encode('utf-8'))
+        count = 0
+        for t, p in probed:
+            record = compact_record(t, p)
+            if record is None:
+                logging.warning(f"Cannot probe {t['infile']}.  Skipping")
+                continue
+            out.write((json.dumps(record) + "\n").encode('utf-8'))
+            count += 1
+        if compress:
+            out.close()
+        stdin.close()
+        logging.debug(f"Streamed {count} files")
+        self.stdout = "".join(stdout.readlines())
+        self.stderr = "".join(stderr.readlines())
+        print(self.stderr, file=sys.stderr)
+
+
+    def capacity(self, function: str, params: dict):
+        """Get how much content fills one job for these parameters"""
+        self._run_remote(['capacity'], {'function': function, 'params': params})
+        if not self.stdout:
+            raise Exception(f"Cannot get capacity.  Stderr: {self.stderr}")
+        return json.loads(self.stdout)
+
+
+    def stage(self, tasklist: list[dict], files: list[str], workers=8):
+        """Copy the input files to the content addressed store on HPC so the
+           jobs read them from the cluster filesystem instead of from here.
+           Files whose content is already there aren't sent again, and the
+           rest are sent in one tar stream.  Returns a copy of the tasklist
+           pointing at the staged files, with the original in localfile."""
+        if not files:
+            return [dict(t) for t in tasklist]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            hashes = dict(zip(files, executor.map(file_sha256, files)))
+        self._run_remote(['stage-check'], sorted(set(hashes.values())))
+        if not self.stdout:
+            raise Exception(f"Cannot check the staged files.  Stderr: {self.stderr}")
+        check = json.loads(self.stdout)
+        staged = check['present']
+        missing = set(check['missing'])
+        logging.info(f"{len(staged)} files are already staged, sending {len(missing)}")
+        if missing:
+            (stdin, stdout, stderr) = self.client.exec_command(shlex.join([self.hpcscript, 'stage']))
+            with tarfile.open(fileobj=stdin, mode="w|") as tar:
+                for f, h in hashes.items():
+                    if h in missing:
+                        tar.add(f, arcname=h)
+                        missing.discard(h)
+            stdin.close()
+            self.stdout = "".join(stdout.readlines())
+            self.stderr = "".join(stderr.readlines())
+            print(self.stderr, file=sys.stderr)
+            if not self.stdout:
+                raise Exception(f"Cannot stage files.  Stderr: {self.stderr}")
+            staged.update(json.loads(self.stdout))
+
+        res = []
+        for t in tasklist:
+            t = dict(t)
+            if t['infile'] in hashes:
+                if hashes[t['infile']] not in staged:
+                    raise Exception(f"{t['infile']} was not staged")
+                t.update({'localfile': t['infile'], 'infile': staged[hashes[t['infile']]], 'staged': True})
+            res.append(t)
+        return res
+
+
     def check(self, id):
-        self._run_remote(f"{self.hpcscript} check {id}")        
+        id = str(id)
+        self._run_remote(['check', str(id)])
         if not self.stdout:
             raise Exception(f"Cannot check.  Stderr: {self.stderr}")        
         data = json.loads(self.stdout)
@@ -79,9 +359,98 @@ class HPCClient:
         return data[id]['job_state']
 
 
+    def check_many(self, ids: list[str]):
+        """Check several jobs, returning a dict of id -> state.  In a
+           session the checks are all sent before any of the responses are
+           read, so they only cost one round trip."""
+        if self.session is None:
+            return {id: self.check(id) for id in ids}
+        reqs = {str(id): self._send(['check', str(id)]) for id in ids}
+        res = {}
+        for id, reqid in reqs.items():
+            self._receive(reqid)
+            if not self.stdout:
+                raise Exception(f"Cannot check.  Stderr: {self.stderr}")
+            data = json.loads(self.stdout)
+            res[id] = data[id]['job_state'] if id in data else None
+        return res
+
+
+
+    def wait(self, ids: list[str], callback=None, interval=10, max_interval=300, timeout=None):
+        """Wait on the HPC side for the jobs to finish, calling callback with
+           a {job_id, job_state} event for each one as it finishes.  Returns
+           a dict of id -> final state, which is None for any that were
+           still running at the timeout."""
+        args = ['wait', '--interval', str(interval), '--max-interval', str(max_interval)]
+        if timeout is not None:
+            args.extend(['--timeout', str(timeout)])
+        args.extend(str(x) for x in ids)
+        if self.session is not None:
+            reqid = self._send(args)
+            if callback:
+                self.listeners[reqid] = callback
+            self._receive(reqid)
+        else:
+            self.client.get_transport().set_keepalive(60)
+            (stdin, stdout, stderr) = self.client.exec_command(shlex.join([self.hpcscript, *args]))
+            self.stdout = ""
+            for line in stdout:
+                data = json.loads(line)
+                if 'job_id' in data and 'job_state' in data:
+                    if callback:
+                        callback(data)
+                else:
+                    self.stdout = line
+            self.stderr = "".join(stderr.readlines())
+            print(self.stderr, file=sys.stderr)
+        if not self.stdout:
+            raise Exception(f"Cannot wait.  Stderr: {self.stderr}")
+        return json.loads(self.stdout)
+
+
+    def fetch_results(self, id, statefile: Path):
+        """Pull the staged results of a job and write them to their outfiles,
+           returning the outfiles that were written.  What has been delivered
+           is kept in the state file (result name -> sha256) so an interrupted
+           fetch picks up where it left off and nothing is sent twice."""
+        delivered = json.loads(statefile.read_text()) if statefile.exists() else {}
+        (stdin, stdout, stderr) = self.client.exec_command(shlex.join([self.hpcscript, 'results', '--owner',
+                                                                      f"{self.scpuser}@{self.scphost}", str(id)]))
+        stdin.write(json.dumps(delivered))
+        stdin.close()
+        written = []
+        try:
+            with tarfile.open(fileobj=stdout, mode="r|gz") as tar:
+                manifest = {}
+                for member in tar:
+                    data = tar.extractfile(member).read()
+                    if member.name == "manifest.json":
+                        manifest = json.loads(data)
+                        continue
+                    entry = manifest[member.name]
+                    if hashlib.sha256(data).hexdigest() != entry['sha256']:
+                        raise Exception(f"Checksum mismatch for {entry['outfile']}")
+                    outfile = Path(entry['outfile'])
+                    tmpfile = outfile.with_name(f".{outfile.name}.tmp")
+                    tmpfile.write_bytes(data)
+                    tmpfile.replace(outfile)
+                    delivered[member.name] = entry['sha256']
+                    written.append(str(outfile))
+        except tarfile.ReadError as e:
+            self.stderr = "".join(stderr.readlines())
+            raise Exception(f"Cannot fetch results for {id}: {e}.  Stderr: {self.stderr}")
+        finally:
+            # whatever made it is delivered, even if the stream broke.
+            tmpfile = statefile.with_name(f".{statefile.name}.tmp")
+            tmpfile.write_text(json.dumps(delivered))
+            tmpfile.replace(statefile)
+        logging.info(f"Fetched {len(written)} results for job {id}")
+        return written
+
 
     def list(self):
-        self._run_remote(f"{self.hpcscript} list")        
+        self._run_remote(['list'])        
         if not self.stdout:
             raise Exception(f"Cannot get list.  Stderr: {self.stderr}")        
         #logging.info(self.stdout)
@@ -90,7 +459,7 @@ class HPCClient:
 
 
     def cancel(self, id):
-        self._run_remote(f"{self.hpcscript} cancel {id}")        
+        self._run_remote(['cancel', str(id)])        
         if not self.stdout:
             raise Exception(f"Cannot cancel.  Stderr: {self.stderr}")        
         return "".join(self.stdout)
@@ -105,7 +474,10 @@ def main():
     subparsers = parser.add_subparsers(help="Command", dest='command', required=True)
     sp = subparsers.add_parser('submit', help="Submit a new job")
     sp = subparsers.add_parser('check', help="Check job status")
-    sp.add_argument("id", help="Job ID")
+    sp.add_argument("id", nargs='+', help="Job ID")
+    sp = subparsers.add_parser('wait', help="Wait for jobs to finish")
+    sp.add_argument("--timeout", type=float, default=None, help="Give up after this many seconds")
+    sp.add_argument("id", nargs='+', help="Job ID")
     sp = subparsers.add_parser('list', help='List all jobs')
     sp.add_argument("--long", '-l', default=False, action="store_true", help="Long listing")
     sp = subparsers.add_parser('cancel', help="Cancel job")
@@ -114,36 +486,24 @@ def main():
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
                         format="%(asctime)s [%(process)d:%(filename)s:%(lineno)d] [%(levelname)s] %(message)s")
 
-    hpc = HPCClient(connectuser=args.hpcuser, hpchost=args.hpchost, hpcscript=args.hpcscript)
+    hpc = HPCClient(connectuser=args.hpcuser, hpchost=args.hpchost, hpcscript=args.hpcscript,
+                    session=args.command == "check" and len(args.id) > 1)
     if args.command == "submit":
         logging.warning("Use a specific hpc client command to submit a job")
         exit(1)
     elif args.command == "check":
-        print(hpc.check(args.id))
+        if len(args.id) == 1:
+            print(hpc.check(args.id[0]))
+        else:
+            for id, state in hpc.check_many(args.id).items():
+                print(f"{id}: {state}")
+            hpc.close_session()
+    elif args.command == "wait":
+        states = hpc.wait(args.id, lambda x: print(f"{x['job_id']}: {x['job_state']}", flush=True), timeout=args.timeout)
+        if None in states.values():
+            exit(1)
     elif args.command == "list":
         data = hpc.list()
-        # clean up the data
-        for f in ('accrue_time', 'admin_comment', 'array_job_id', 'array_task_id',
-                  'array_max_tasks', 'array_task_string', 'association_id', 'batch_features',
-                  'batch_flag', 'flags', 'burst_buffer', 'burst_buffer_state', 
-                  'cluster', 'cluster_features', 'container', 'contiguous', 'core_spec',
-                  'thread_spec', 'cores_per_socket', 'billable_tres', 'cpus_per_task',
-                  'cpu_frequency_minimum', 'cpu_frequency_maximum', 'cpu_frequency_governor',
-                  'cpus_per_tres', 'deadline', 'delay_boot', 'dependency', 'eligible_time',
-                  'excluded_nodes', 'features', 'federation_origin', 'federation_siblings_active',
-                  'federation_siblings_viable', 'gres_detail', 'last_sched_evaulation',
-                  'licenses', 'max_cpus', 'max_nodes', 'mcs_label', 'memory_per_tres',
-                  'nice', 'tasks_per_core', 'tasks_per_node', 'tasks_per_socket', 'tasks_per_board',
-                  'het_job_id', 'het_job_id_set', 'het_job_offset', 'prefer', 'memory_per_node',
-                  'memory_per_cpu', 'minimum_cpus_per_node', 'minimum_tmp_disk_per_node',
-                  'preempt_time', 'pre_sus_time', 'profile', 'reboot', 'required_nodes',
-                  'resize_time', 'resize_cnt', 'resv_name', 'shared', 'show_flags',
-                  'sockets_per_board', 'sockets_per_node', 'suspend_time', 'time_minimum',
-                  'threads_per_core', 'tres_bind', 'tres_freq', 'tres_per_job', 'tres_per_node',
-                  'tres_per_socket', 'tres_per_task', 'wckey'):
-            for d in data:
-                data[d].pop(f, None)
-
         if args.long:
             print(json.dumps(data, indent=4))
         else:
@@ -1,124 +1,786 @@
 #!/usr/bin/env python3
 # client and server bits for the HPC Service
 import argparse
+import contextlib
 import logging
 import json
 import getpass
+import gzip
+import hashlib
+import io
 import socket
+import tarfile
 import configparser
 from slurm import Slurm
+import planner
+import costmodel
+from accounting import Accounting
+from taskqueue import TaskQueue
 import ffprobe
 import sys
 from pathlib import Path
 import time
-from math import floor
+import os
+import re
+from math import floor, ceil
 
-def main():
+def make_cost_functions(costs: costmodel.CostModel, params: dict, gpu: bool, processing_factor: float):
+    """Create the expected and p95 cost functions for tasks.  When the cost
+       model doesn't know about these parameters, the static processing
+       factor from the configuration is used instead."""
+    cparams = dict(params)
+    cparams['device'] = 'cuda' if gpu else 'cpu'
+    if costs.lookup(cparams, '*') is None:
+        logging.info(f"No cost model for {costmodel.model_key(cparams['engine'], cparams['model'], cparams['device'], cparams.get('vad', False), '*', cparams.get('batch_size', 1), bool(cparams.get('skip_silence')))}, using processing factor {processing_factor}")
+
+    def cost(t, stat='mean'):
+        # the known silences aren't transcribed when they're skipped
+        duration = speech_duration(t, params['skip_silence']) if params.get('skip_silence') else t['duration']
+        c = costs.predict(cparams, t.get('media_type', 'unknown'), duration, stat=stat)
+        if c is None:
+            c = duration / processing_factor
+            if stat == 'p95':
+                c *= 1.5
+        return c
+
+    return cost, lambda t: cost(t, 'p95')
+
+
+def speech_duration(task: dict, min_silence=0):
+    """The seconds of a task (or part of one) which aren't in its known
+       silences of at least min_silence seconds"""
+    start = task.get('start', 0.0)
+    end = start + task['duration']
+    silent = sum(max(0.0, min(end, e) - max(start, s)) for s, e in task.get('silence', []) if e - s >= min_silence)
+    return max(0.0, task['duration'] - silent)
+
+
+def whisper_resources(params: dict, sconfig, wconfig, concurrent_batches=None):
+    """Compute the per-job resources for whisper parameters"""
+    batch_size = params.get('batch_size', 1) if params['engine'] == 'faster_whisper' else 1
+    if params['device'] == "cuda":
+        shared = sconfig.getboolean('shared_model', False)
+        if concurrent_batches is None:
+            if shared:
+                # one copy of the model serves the whole job, so the vram
+                # doesn't limit anything and the batches are the files it
+                # works on at once.  whisper's decoder can only do one.
+                concurrent_batches = 1 if params['engine'] == 'whisper' else int(sconfig.get('model_streams', 2))
+            else:
+                vram = int(wconfig['model_vram'])
+                if batch_size > 1:
+                    # the segments being decoded together need room too
+                    vram += batch_size * float(wconfig.get('batch_vram', 0.25))
+                concurrent_batches = floor(int(sconfig['gpu_vram']) / vram) + 1
+        processing_factor = float(wconfig['gpu_factor'])
+        if batch_size > 1:
+            # batching gets more out of the gpu, but not without limit
+            processing_factor *= min(batch_size, float(wconfig.get('max_batch_speedup', 4)))
+        # the model server's workers each need a cpu to fetch and decode
+        host_cpus = max(4, int(sconfig.get('io_workers', 8))) if shared else 4
+        host_ram = 64
+        gpus = 1
+        slot_cpus = slot_ram = None
+    else:
+        if concurrent_batches is None:
+            concurrent_batches = int(wconfig['cpu_batches'])
+        processing_factor = float(wconfig['cpu_factor'])
+        slot_cpus = int(wconfig['cpu_count'])
+        slot_ram = int(wconfig['cpu_model_ram'])
+        host_cpus = concurrent_batches * slot_cpus
+        host_ram = concurrent_batches * slot_ram
+        gpus = 0
+
+    logging.info(f"Initial resource request:  {host_cpus} cpus, {host_ram} RAM")
+    host_ram = min([host_ram, int(sconfig['cpu_ram'])])
+    host_cpus = min([host_cpus, int(sconfig['cpu_threads'])])
+    return {'concurrent_batches': concurrent_batches,
+            'processing_factor': processing_factor,
+            'cpus': host_cpus,
+            'ram': host_ram,
+            'gpus': gpus,
+            'slot_cpus': slot_cpus,
+            'slot_ram': slot_ram}
+
+
+def model_server(sconfig, gpus: int, streams: int):
+    """The settings for a job's shared model server, or None if each worker
+       loads its own model"""
+    if not gpus or not sconfig.getboolean('shared_model', False):
+        return None
+    return {'streams': streams, 'workers': max(streams, int(sconfig.get('io_workers', 8)))}
+
+
+# hpc_whisper_server reads the remote file being decoded this much at a time
+FEED_WINDOW = 16 * 1024 ** 2
+
+
+def audio_ram(tasks: list[dict], workers: int, prefetch: int, shared=False):
+    """The memory (GB) for the decoded audio a job can hold at once.  Every
+       worker has prefetch files waiting, one being decoded and one being
+       transcribed (plus its shared memory copy with a model server), as
+       16kHz float32, and at worst they're the longest files in the job.
+       The one being decoded also has a window of the remote file."""
+    count = workers * (prefetch + 2 + (1 if shared else 0))
+    longest = sorted((t['duration'] for t in tasks), reverse=True)[:count]
+    return ceil((sum(longest) * 16000 * 4 + workers * FEED_WINDOW) / 1024 ** 3)
+
+
+def read_request(stream):
+    """Read a submission from a binary stream.  It's either a single json
+       document with the full ffprobe output for every file, or json lines
+       where the first line is the document without the tasklist and probes
+       (and "format": "jsonl") and every following line is a compact record
+       for one file:
+          {"infile": ..., "outfile": ..., "duration": 1234.5, "streams": {"audio": 1}}
+       which can also have the sha256 and the known silences.
+       Either can be gzipped.  The json lines records are turned into tasks
+       as they're read so the whole submission is never in memory."""
+    if not hasattr(stream, 'peek'):
+        stream = io.BufferedReader(stream)
+    if stream.peek(2)[:2] == b"\x1f\x8b":
+        stream = gzip.GzipFile(fileobj=stream)
+    text = io.TextIOWrapper(stream, encoding='utf-8')
+    first = text.readline()
+    try:
+        header = json.loads(first)
+    except json.JSONDecodeError:
+        # a document that has been pretty printed
+        return json.loads(first + text.read())
+    if header.get('format') != 'jsonl':
+        return header
+    header['tasklist'] = list(stream_tasks(text))
+    return header
+
+
+def stream_tasks(lines):
+    """Turn the compact json lines records into tasks"""
+    for line in lines:
+        if not line.strip():
+            continue
+        r = json.loads(line)
+        if 'audio' not in r['streams']:
+            logging.warning(f"Input file {r['infile']} doesn't have an audio stream.  Skipping")
+            continue
+        task = {'infile': r['infile'], 'outfile': r['outfile'], 'duration': float(r['duration']),
+                'media_type': costmodel.media_type_of(r['streams'])}
+        for k in ('sha256', 'silence', 'staged'):
+            if k in r:
+                task[k] = r[k]
+        yield task
+
+
+def prepare_tasks(request: dict):
+    """Get the tasks which can be processed, with their durations and media
+       types from the probes"""
+    tasks = []
+    for p in request['tasklist']:
+        if 'duration' in p and 'media_type' in p:
+            # streamed submissions already have them
+            tasks.append(p)
+            continue
+        if p['infile'] not in request.get('probes', {}):
+            logging.warning(f"Input file {p['infile']} has not been probed.  Skipping")
+            continue
+        if 'audio' not in request['probes'][p['infile']]['_stream_types']:
+            logging.warning(f"Input file {p['infile']} doesn't have an audio stream.  Skipping")
+            continue
+        p['duration'] = float(request['probes'][p['infile']]['format']['duration'])
+        p['media_type'] = costmodel.media_type_of(request['probes'][p['infile']]['_stream_types'])
+        tasks.append(p)
+    return tasks
+
+
+def plan_whisper(request: dict, config, overrides=None, acct: Accounting=None, backfill=None):
+    """Plan a whisper request into jobs without submitting anything.  The
+       overrides can replace the planner, max_slot_target, and
+       concurrent_batches settings for comparing plans.  If accounting is
+       given, the resource requests are sized from the usage history.  If
+       backfill is given (from Slurm.backfill_window) and there are idle
+       nodes, the work is split into more, shorter jobs that fit in the
+       backfill window."""
+    overrides = overrides or {}
+    sconfig = config['slurm']            
+    params = request['params']            
+    wconfig = config[f"{params['engine']}.{params['model']}"]
+    res = whisper_resources(params, sconfig, wconfig, overrides.get('concurrent_batches', None))
+    concurrent_batches = res['concurrent_batches']
+    processing_factor = res['processing_factor']
+
+    target_slot_time = int(overrides.get('max_slot_target', sconfig['max_slot_target']))
+    max_content_time = target_slot_time * processing_factor
+    
+    logging.info(f"({params['engine']}.{params['model']}) on {params['device']}, there are {concurrent_batches} concurrent batches each with a max content time of {max_content_time} requiring {res['cpus']} CPUS, {res['ram']} RAM, and {res['gpus']} GPUS")
+
+    tasks = prepare_tasks(request)
+
+    # plan the tasks into jobs of concurrent batches.
+    costs = costmodel.CostModel.load(sconfig.get('costmodel', f"{sconfig['batchdir']}/costmodel.json"))
+    cost, cost_p95 = make_cost_functions(costs, params, res['gpus'] > 0, processing_factor)
+    policy = overrides.get('planner', sconfig.get('planner', 'lpt'))
+    overlap = float(sconfig.get('split_overlap', 30))
+    tasks = [part for t in tasks for part in planner.split_task(t, target_slot_time, cost, overlap)]
+    for t in tasks:
+        t['predicted'] = cost(t)
+    jobs = planner.plan_batches(tasks, target_slot_time, concurrent_batches, cost, policy=policy)
+    report = planner.predict_makespan(jobs, cost, cost_p95)
+    for n, j in enumerate(report['jobs']):
+        logging.info(f"Job {n}: predicted makespan {j['makespan']:0.1f}s (p95 {j['makespan_p95']:0.1f}s), slots: {[round(x, 1) for x in j['slots']]}, idle slot time {j['idle']:0.1f}s")
+    logging.info(f"Planned {len(tasks)} files into {len(jobs)} jobs using the {policy} planner, predicted makespan {report['makespan']:0.1f}s (p95 {report['makespan_p95']:0.1f}s)")
+
+    plan = {
+        'function': 'whisper',
+        'params': params,
+        'planner': policy,
+        'max_slot_target': target_slot_time,
+        'concurrent_batches': concurrent_batches,
+        'task_count': len(tasks),
+        'makespan': report['makespan'],
+        'makespan_p95': report['makespan_p95'],
+        'total_work': report['total_work'],
+        'jobs': []
+    }
+    prefetch = int(sconfig.get('prefetch', 2))
+    for n, j in enumerate(jobs):
+        server = model_server(sconfig, res['gpus'], len(j))
+        workers = server['workers'] if server else len(j)
+        # CPU jobs with fewer batches than slots don't need everything.
+        ram = res['ram'] if res['slot_ram'] is None else min(res['ram'], len(j) * res['slot_ram'])
+        ram = min(ram + audio_ram([t for b in j for t in b], workers, prefetch, server is not None), int(sconfig['cpu_ram']))
+        plan['jobs'].append({
+            'batches': j,
+            'params': params,
+            'gpus': res['gpus'],
+            'cpus': res['cpus'] if res['slot_cpus'] is None else min(res['cpus'], len(j) * res['slot_cpus']),
+            'ram': ram,
+            'job_time': shape_walltime(report['jobs'][n]['makespan'], report['jobs'][n]['makespan_p95'], sconfig),
+            'slots': report['jobs'][n]['slots'],
+            'makespan': report['jobs'][n]['makespan'],
+            'makespan_p95': report['jobs'][n]['makespan_p95'],
+        })
+
+    if backfill and backfill['window'] is not None and 0 < len(jobs) < backfill['idle_nodes']:
+        longest = max(j['job_time'] for j in plan['jobs']) * 60
+        if longest > backfill['window']:
+            # shorter jobs can start right away on the idle nodes instead
+            # of waiting behind the jobs at the top of the queue.
+            startup = float(sconfig.get('job_startup', 300))
+            margin = float(sconfig.get('walltime_margin', 0.25))
+            target = int(max(float(sconfig.get('min_slot_target', 900)), (backfill['window'] - startup) / (1 + margin)))
+            if target < target_slot_time:
+                bplan = plan_whisper(request, config, dict(overrides, max_slot_target=target), acct)
+                if len(bplan['jobs']) <= backfill['idle_nodes']:
+                    logging.info(f"Reshaped into {len(bplan['jobs'])} jobs with a {target}s slot target to fit the {backfill['window']:0.0f}s backfill window on {backfill['idle_nodes']} idle nodes")
+                    bplan['backfill'] = backfill
+                    return bplan
+
+    if acct is not None:
+        right_size(plan, acct, sconfig)
+    return plan
+
+
+def shape_walltime(makespan: float, makespan_p95: float, sconfig):
+    """The walltime, in minutes, to request for a job:  the predicted
+       makespan plus a safety margin (or the p95 estimate if it's longer)
+       and the time to start up."""
+    margin = float(sconfig.get('walltime_margin', 0.25))
+    startup = float(sconfig.get('job_startup', 300))
+    return ceil((max(makespan * (1 + margin), makespan_p95) + startup) / 60)
+
+
+def right_size(plan: dict, acct: Accounting, sconfig):
+    """Replace the resource requests in a plan with recommendations from the
+       accounting history, when there's enough of it"""
+    percentile = float(sconfig.get('accounting_percentile', 0.95))
+    margin = float(sconfig.get('accounting_margin', 0.1))
+    for n, j in enumerate(plan['jobs']):
+        key = resource_key(j['params'])
+        rec = acct.recommend(key, len(j['batches']), j['makespan'], percentile=percentile, margin=margin)
+        if rec is None:
+            logging.debug(f"Not enough accounting history for {key}")
+            continue
+        old = (j['cpus'], j['ram'], j['job_time'])
+        j['ram'] = max(1, min(rec['ram'], int(sconfig['cpu_ram'])))
+        if rec['cpus'] is not None:
+            j['cpus'] = min(rec['cpus'], int(sconfig['cpu_threads']))
+        if rec['job_time'] is not None:
+            j['job_time'] = max(5, rec['job_time'])
+        logging.info(f"Job {n}: right-sized from {rec['samples']} previous jobs: cpus {old[0]} -> {j['cpus']}, ram {old[1]} -> {j['ram']}, minutes {old[2]} -> {j['job_time']}")
+
+
+def resource_key(params: dict):
+    """The key for grouping jobs with similar resource usage"""
+    if params.get('batch_size', 1) > 1:
+        return f"{params['engine']}/{params['model']}@b{params['batch_size']}/{params['device']}"
+    return f"{params['engine']}/{params['model']}/{params['device']}"
+
+
+def job_metadata(j: dict):
+    """The metadata saved with a job for the accounting"""
+    return {'key': resource_key(j['params']),
+            'slots': len(j['batches']),
+            'files': sum(len(b) for b in j['batches']),
+            'predicted': j['makespan'],
+            'predicted_p95': j['makespan_p95'],
+            'requested': {'cpus': j['cpus'], 'ram': j['ram'], 'job_time': j['job_time']}}
+
+
+def plan_hybrid(request: dict, config, slurm: Slurm, overrides=None, acct: Accounting=None, backfill=False):
+    """Plan a whisper request across both GPU and CPU jobs so that both
+       sides are predicted to finish at about the same time, given the
+       throughput of each device and how long the queue is for each."""
+    sconfig = config['slurm']
+    params = request['params']
+    wconfig = config[f"{params['engine']}.{params['model']}"]
+    costs = costmodel.CostModel.load(sconfig.get('costmodel', f"{sconfig['batchdir']}/costmodel.json"))
+    tasks = prepare_tasks(request)
+    overrides = overrides or {}
+    target_slot_time = int(overrides.get('max_slot_target', sconfig['max_slot_target']))
+    policy = overrides.get('planner', sconfig.get('planner', 'lpt'))
+    overlap = float(sconfig.get('split_overlap', 30))
+
+    def side_plan(cost, concurrent_batches):
+        # the job makespans plan_whisper would come up with for the tasks
+        def plan(tasks):
+            parts = [part for t in tasks for part in planner.split_task(t, target_slot_time, cost, overlap)]
+            jobs = planner.plan_batches(parts, target_slot_time, concurrent_batches, cost, policy=policy)
+            return [j['makespan'] for j in planner.predict_makespan(jobs, cost)['jobs']]
+        return plan
+
+    sides = {}
+    for device, kind, default_partition, default_jobs in (('cuda', 'gpu', 'gpu', 4), ('cpu', 'cpu', 'general', 16)):
+        dparams = dict(params, device=device)
+        res = whisper_resources(dparams, sconfig, wconfig, overrides.get('concurrent_batches', None))
+        cost, _ = make_cost_functions(costs, dparams, device == 'cuda', res['processing_factor'])
+        backlog = slurm.queue_backlog(sconfig.get(f"{kind}_partition", default_partition))
+        if backlog['wait'] is not None:
+            wait = backlog['wait']
+        else:
+            wait = backlog['pending'] * float(sconfig.get('wait_per_pending', 60))
+        # how many jobs can be running at the same time on this device
+        max_jobs = int(sconfig.get(f"max_{kind}_jobs", default_jobs))
+        sides[device] = {'cost': cost, 'wait': wait, 'jobs': max_jobs,
+                         'plan': side_plan(cost, res['concurrent_batches'])}
+        logging.info(f"Hybrid {device}: {backlog['pending']} pending jobs in the queue, estimated wait {wait:0.0f}s, {max_jobs} concurrent jobs of {res['concurrent_batches']} slots")
+
+    split = planner.split_hybrid(tasks, sides['cuda'], sides['cpu'])
+    logging.info(f"Hybrid split: {len(split['cuda'])} files on GPU finishing around {split['finish']['cuda']:0.0f}s, {len(split['cpu'])} files on CPU finishing around {split['finish']['cpu']:0.0f}s")
+
+    plans = []
+    for device in ('cuda', 'cpu'):
+        if split[device]:
+            sub = dict(request, params=dict(params, device=device), tasklist=split[device])
+            window = None
+            if backfill:
+                window = slurm.backfill_window(sconfig.get(f"{'gpu' if device == 'cuda' else 'cpu'}_partition",
+                                                           'gpu' if device == 'cuda' else 'general'))
+            plans.append(plan_whisper(sub, config, overrides, acct, window))
+
+    plan = dict(plans[0]) if plans else {'function': 'whisper', 'task_count': 0, 'makespan': 0.0,
+                                         'makespan_p95': 0.0, 'total_work': 0.0}
+    plan.update({
+        'params': params,
+        'task_count': sum(p['task_count'] for p in plans),
+        'makespan': max([p['makespan'] for p in plans], default=0.0),
+        'makespan_p95': max([p['makespan_p95'] for p in plans], default=0.0),
+        'total_work': sum(p['total_work'] for p in plans),
+        'predicted_finish': split['finish'],
+        'jobs': [j for p in plans for j in p['jobs']],
+    })
+    return plan
+
+
+def submit_plan(slurm: Slurm, plan: dict, request: dict, email: str, sconfig):
+    """Submit the jobs in a plan, returning the job ids"""
+    p = sys.path[0].replace("/geode2/", "/N/")
+    payloads = []
+    for j in plan['jobs']:
+        data = {
+            'scphost': request['scphost'],
+            'scpuser': request['scpuser'],
+            'params': j['params'],
+            'batches': j['batches'],
+            'results': request.get('results', 'push'),
+            'prefetch': int(sconfig.get('prefetch', 2)),
+            'speculate': float(sconfig.get('speculate', 0)),
+            'walltime': j['job_time'] * 60,
+            'shared_model': model_server(sconfig, j['gpus'], len(j['batches'])),
+        }
+        payloads.append(json.dumps(data, indent=4))
+
+    jobids = []
+    if sconfig.getboolean('array_jobs', False) and payloads:
+        # one array job for each set of resources:  the tasks all get the
+        # longest walltime since they share a script.
+        scriptbody = f"time apptainer run --nv {p}/hpc_python.sif {p}/hpc_whisper_server.py < $PAYLOAD\n"
+        throttle = sconfig.get('array_throttle', None)
+        groups = {}
+        for payload, j in zip(payloads, plan['jobs']):
+            groups.setdefault((j['gpus'], j['cpus'], j['ram'], j['params']['engine']), []).append((payload, j))
+        for (gpus, cpus, ram, engine), group in groups.items():
+            jobids.extend(slurm.submit_array(scriptbody, [x[0] for x in group], email, gpu=gpus, cpu=cpus,
+                                             job_time=max(x[1]['job_time'] for x in group), ram=ram, tag=engine,
+                                             throttle=int(throttle) if throttle else None,
+                                             metadata=[job_metadata(x[1]) for x in group]))
+    else:
+        for payload, j in zip(payloads, plan['jobs']):
+            scriptbody = f"time apptainer run --nv {p}/hpc_python.sif {p}/hpc_whisper_server.py <<EOF\n"
+            scriptbody += payload + "\n"
+            scriptbody += "EOF\n"
+            jobids.append(str(slurm.submit(scriptbody, email, gpu=j['gpus'], cpu=j['cpus'], job_time=j['job_time'], ram=j['ram'], tag=j['params']['engine'],
+                                           metadata=job_metadata(j))))
+    return jobids
+
+
+def submit_pilots(slurm: Slurm, plan: dict, request: dict, email: str, sconfig):
+    """Put the tasks of a plan into the pilot queue for their parameters
+       and start more pilot jobs if the pilots which are already running
+       can't get through the backlog.  Returns the ids of all of the pilots
+       working on the queues."""
+    p = sys.path[0].replace("/geode2/", "/N/")
+    walltime = int(sconfig.get('pilot_walltime', 14400))
+    startup = float(sconfig.get('job_startup', 300))
+    max_pilots = int(sconfig.get('max_pilots', 8))
+    groups = {}
+    for j in plan['jobs']:
+        groups.setdefault((j['params']['engine'], j['params']['model'], j['params']['device']), []).append(j)
+
+    jobids = []
+    for (engine, model, device), jobs in groups.items():
+        key = f"{engine}_{model}_{device}"
+        queue = TaskQueue(Path(sconfig['batchdir']) / "queue" / key)
+        tag = f"pilot_{key}"
+        # this decides which claims get done again, so it can't be a stale
+        # snapshot or a failed squeue which makes running pilots look gone.
+        queued = slurm.active_jobs()
+        if queued is None:
+            raise RuntimeError(f"Cannot get the queue to find the pilots for {key}")
+        active = [k for k, v in queued.items() if f"-{tag}-" in v['name']]
+        # anything claimed by a pilot that is gone needs to be done again.
+        for owner in queue.owners():
+            if owner.split(".")[0] not in active:
+                queue.requeue(owner)
+
+        for j in jobs:
+            for b in j['batches']:
+                for t in b:
+                    task = {'scphost': request['scphost'],
+                            'scpuser': request['scpuser'],
+                            'params': j['params'],
+                            'spec': t}
+                    if request.get('results', 'push') == 'pull':
+                        # any pilot may do it, so it can't go in the pilot's directory
+                        task['resultdir'] = str(queue.path / "results")
+                    queue.enqueue(task, t['predicted'])
+
+        slots = max(len(j['batches']) for j in jobs)
+        capacity = (walltime - startup) * slots
+        needed = min(max_pilots, ceil(queue.pending_work() / capacity)) - len(active)
+        logging.info(f"Pilot queue {key}: {len(queue.pending())} tasks pending, {len(active)} pilots active, starting {max(0, needed)} more")
+        jobids.extend(active)
+        for _ in range(max(0, needed)):
+            data = {
+                'pilot': {'queue': str(queue.path), 'walltime': walltime - startup, 'workers': slots,
+                          'idle_timeout': int(sconfig.get('pilot_idle_timeout', 60))},
+                'params': jobs[0]['params'],
+                'prefetch': int(sconfig.get('prefetch', 2)),
+                'speculate': float(sconfig.get('speculate', 0)),
+                'shared_model': model_server(sconfig, jobs[0]['gpus'], slots),
+            }
+            scriptbody = f"time apptainer run --nv {p}/hpc_python.sif {p}/hpc_whisper_server.py <<EOF\n"
+            scriptbody += json.dumps(data, indent=4) + "\n"
+            scriptbody += "EOF\n"
+            jobids.append(str(slurm.submit(scriptbody, email, gpu=jobs[0]['gpus'], cpu=max(j['cpus'] for j in jobs),
+                                           job_time=ceil(walltime / 60), ram=max(j['ram'] for j in jobs), tag=tag)))
+    return jobids
+
+
+def result_dir(slurm: Slurm, jobid: str):
+    """Where a job stages the results to be pulled.  Pilots share one for
+       their queue."""
+    job_dir = slurm.job_dir(jobid)
+    if job_dir is None:
+        return None
+    if "-pilot_" in job_dir.name:
+        key = job_dir.name.split("-pilot_", 1)[1].rsplit("-", 2)[0]
+        return slurm.batchdir / "queue" / key / "results"
+    return job_dir / "results"
+
+
+def write_results(slurm: Slurm, jobid: str, owner: str, have: dict, out):
+    """Write the staged results of a job for an owner (scpuser@scphost) to
+       out as a gzipped tar stream.  The first member is manifest.json which
+       maps each member name to its outfile, size and sha256.  Results that
+       are in have (name -> sha256) with the same checksum are left out, so
+       a fetch can be resumed or repeated without sending anything twice."""
+    rdir = result_dir(slurm, jobid)
+    if rdir is None:
+        raise ValueError(f"Cannot find the directory for job {jobid}")
+    manifest = {}
+    for f in sorted((rdir / owner).glob("*.json")):
+        data = f.read_bytes()
+        sha256 = hashlib.sha256(data).hexdigest()
+        if have.get(f.name) == sha256:
+            continue
+        manifest[f.name] = {'outfile': json.loads(data)['_job']['outfile'], 'size': len(data), 'sha256': sha256}
+    logging.info(f"Sending {len(manifest)} results for job {jobid} to {owner}")
+
+    with tarfile.open(fileobj=out, mode="w|gz") as tar:
+        data = json.dumps(manifest).encode('utf-8')
+        info = tarfile.TarInfo("manifest.json")
+        info.size = len(data)
+        info.mtime = time.time()
+        tar.addfile(info, io.BytesIO(data))
+        for name in manifest:
+            tar.add(rdir / owner / name, arcname=name)
+
+
+def stage_dir(config):
+    """The content addressed store for staged input files"""
+    return Path(config['slurm'].get('stage_dir', f"{config['slurm']['batchdir']}/store"))
+
+
+def blob_path(store: Path, sha256: str):
+    if not re.fullmatch(r"[0-9a-f]{64}", sha256):
+        raise ValueError(f"Not a sha256: {sha256}")
+    return store / sha256[:2] / sha256
+
+
+def stage_check(store: Path, hashes: list[str]):
+    """Find which of the blobs are already in the store.  The ones that are
+       get touched so anything cleaning up old blobs will leave them alone."""
+    res = {'present': {}, 'missing': []}
+    for h in hashes:
+        path = blob_path(store, h)
+        if path.exists():
+            os.utime(path)
+            res['present'][h] = str(path)
+        else:
+            res['missing'].append(h)
+    return res
+
+
+def stage_blobs(store: Path, stream):
+    """Store the files in a tar stream where each member is named by the
+       sha256 of its content.  Each one is checked and renamed into place
+       so nothing ever sees a partial or corrupt blob.  Returns a dict of
+       sha256 -> path for the ones that were stored."""
+    stored = {}
+    with tarfile.open(fileobj=stream, mode="r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            dest = blob_path(store, member.name)
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            tmpfile = dest.with_name(f".{member.name}.{os.getpid()}")
+            h = hashlib.sha256()
+            data = tar.extractfile(member)
+            with open(tmpfile, "wb") as f:
+                while chunk := data.read(1024 * 1024):
+                    h.update(chunk)
+                    f.write(chunk)
+            if h.hexdigest() != member.name:
+                logging.error(f"Staged file {member.name} has checksum {h.hexdigest()}, discarding it")
+                tmpfile.unlink()
+                continue
+            os.replace(tmpfile, dest)
+            stored[member.name] = str(dest)
+    logging.info(f"Staged {len(stored)} files in {store}")
+    return stored
+
+
+def plan_summary(plan: dict):
+    """The plan without the batch contents, for dry runs"""
+    summary = {k: v for k, v in plan.items() if k != 'jobs'}
+    summary['jobs'] = []
+    for j in plan['jobs']:
+        js = {k: v for k, v in j.items() if k != 'batches'}
+        js['files'] = [len(b) for b in j['batches']]
+        summary['jobs'].append(js)
+    return summary
+
+
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", default=False, action="store_true", help="Turn on debugging")
     parser.add_argument("--config", type=str, default=sys.path[0] + "/hpc_batch.ini", help="alternate config file")
     subparsers = parser.add_subparsers(help="Command", dest='command')
     sp = subparsers.add_parser('submit', help="Submit a new job")
+    sp.add_argument("--dry-run", default=False, action="store_true", help="Plan the jobs but don't submit them")
+    sp = subparsers.add_parser('plan', help="Plan a submission without submitting it")
+    sp.add_argument("--planner", choices=list(planner.PLANNERS.keys()), help="Override the planner policy")
+    sp.add_argument("--max-slot-target", type=int, help="Override the slot target time in seconds")
+    sp.add_argument("--concurrent-batches", type=int, help="Override the number of concurrent batches per job")
+    sp.add_argument("--full", default=False, action="store_true", help="Include the batch contents in the plan")
+    sp = subparsers.add_parser('capacity', help="How many seconds of content fill a job for a request")
+    sp = subparsers.add_parser('accounting', help="Update the resource accounting for finished jobs")
+    sp.add_argument("--days", type=int, default=7, help="How far back to look")
     sp = subparsers.add_parser('check', help="Check job status")
+    sp.add_argument("--all", default=False, action="store_true", help="Include jobs which have left the queue")
     sp.add_argument("id", help="Job ID")
     sp = subparsers.add_parser('list', help='List all jobs')
     sp = subparsers.add_parser('cancel', help="Cancel job")
     sp.add_argument("id", help="Job ID")
-    args = parser.parse_args()
-    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
-                        format="%(asctime)s [%(process)d:%(filename)s:%(lineno)d] [%(levelname)s] %(message)s")
+    sp = subparsers.add_parser('wait', help="Wait for jobs to finish, printing each one as it does")
+    sp.add_argument("--interval", type=float, default=10, help="Initial seconds between polls")
+    sp.add_argument("--max-interval", type=float, default=300, help="Longest seconds between polls")
+    sp.add_argument("--timeout", type=float, help="Give up after this many seconds")
+    sp.add_argument("id", nargs='+', help="Job IDs")
+    sp = subparsers.add_parser('results', help="Send the staged results of a job as a tar stream")
+    sp.add_argument("--owner", required=True, help="scpuser@scphost the results are for")
+    sp.add_argument("id", help="Job ID")
+    sp = subparsers.add_parser('stage-check', help="Find which files (by sha256 on stdin) are already staged")
+    sp = subparsers.add_parser('stage', help="Stage the files in a tar stream on stdin, named by their sha256")
+    sp = subparsers.add_parser('serve', help="Run commands from JSON lines on stdin until it is closed")
+    return parser
 
-    # read the config
-    config = configparser.ConfigParser()
-    config.read(args.config)
-    
-    slurm = Slurm(config['slurm']['account'], config['slurm']['batchdir'])
 
-    if args.command == "submit":
-        request = json.loads(sys.stdin.read())
+def run_command(args, config, slurm: Slurm, stdin_data=None, emit=None):
+    """Run a command and return what it would print.  Commands which report
+       progress (wait) pass each event to emit as it happens."""
+    if isinstance(stdin_data, str):
+        stdin_data = io.BytesIO(stdin_data.encode('utf-8'))
+
+    if args.command == "capacity":
+        # the request only needs the function and params
+        request = read_request(stdin_data)
+        if request['function'] != 'whisper':
+            raise ValueError(f"Unknown function: {request['function']}")
+        params = request['params']
+        # hybrid fills the faster side first
+        params = dict(params, device='cuda' if params['device'] == 'hybrid' else params['device'])
+        res = whisper_resources(params, config['slurm'], config[f"{params['engine']}.{params['model']}"])
+        slot_target = int(config['slurm']['max_slot_target'])
+        return json.dumps({'max_slot_target': slot_target,
+                           'concurrent_batches': res['concurrent_batches'],
+                           'processing_factor': res['processing_factor'],
+                           'job_content': slot_target * res['processing_factor'] * res['concurrent_batches']})
+
+    elif args.command in ("submit", "plan"):
+        request = read_request(stdin_data)
         email = request.get('email', None)
         if email is None: 
             email = config['slurm']['email']
 
+        acct = None
+        if config['slurm'].getboolean('accounting', False):
+            acct = Accounting(slurm)
+            if args.command == "submit" and not args.dry_run:
+                acct.refresh(int(config['slurm'].get('accounting_days', 7)))
+
         if request['function'] == 'whisper':
-            # load the correct configuration and compute our limits.
-            sconfig = config['slurm']            
-            params = request['params']            
-            wconfig = config[f"{params['engine']}.{params['model']}"]
-            if params['device'] == "cuda":
-                concurrent_batches = floor(int(sconfig['gpu_vram']) / int(wconfig['model_vram'])) + 1
-                processing_factor = float(wconfig['gpu_factor'])
-                host_cpus =  4
-                host_ram = 64
-                gpus = 1
+            overrides = {}
+            if args.command == "plan":
+                overrides = {k: v for k, v in (('planner', args.planner),
+                                               ('max_slot_target', args.max_slot_target),
+                                               ('concurrent_batches', args.concurrent_batches)) if v is not None}
+            backfill = config['slurm'].getboolean('backfill', False)
+            if request['params']['device'] == 'hybrid':
+                plan = plan_hybrid(request, config, slurm, overrides, acct, backfill)
             else:
-                concurrent_batches = int(wconfig['cpu_batches'])
-                processing_factor = float(wconfig['cpu_factor'])
-                host_cpus = concurrent_batches * int(wconfig['cpu_count'])
-                host_ram = concurrent_batches * int(wconfig['cpu_model_ram'])                
-                gpus = 0
-
-            logging.info(f"Initial resource request:  {host_cpus} cpus, {host_ram} RAM")
-            host_ram = min([host_ram, int(sconfig['cpu_ram'])])
-            host_cpus = min([host_cpus, int(sconfig['cpu_threads'])])
-
-            target_slot_time = int(sconfig['max_slot_target'])
-            max_content_time = target_slot_time * processing_factor
-            
-            logging.info(f"({params['engine']}.{params['model']}) on {params['device']}, there are {concurrent_batches} concurrent batches each with a max content time of {max_content_time} requiring {host_cpus} CPUS, {host_ram} RAM, and {gpus} GPUS")
-
-            batches = [[]]
-            batch_sizes = [0.0]
-            for p in request['tasklist']:
-                if p['infile'] not in request['probes']:
-                    logging.warning(f"Input file {p['infile']} has not been probed.  Skipping")
-                    continue
-                if 'audio' not in request['probes'][p['infile']]['_stream_types']:
-                    logging.warning(f"Input file {p['infile']} doesn't have an audio stream.  Skipping")
-                    continue
-
-                d = float(request['probes'][p['infile']]['format']['duration'])
-                p['duration'] = d
-                if batch_sizes[-1] + d > max_content_time:
-                    # only start a new one if there's something already in this batch
-                    if len(batches[-1]) > 0:                        
-                        batches.append([])
-                        batch_sizes.append(0)
-                batch_sizes[-1] += d
-                batches[-1].append(p)
-                
-            # group the batches into jobs
-            #batch_per_job = int(config['whisper']['concurrent'])
-            jobs = [batches[i:i+concurrent_batches] for i in range(0, len(batches), concurrent_batches)]            
-            jobids = []
-            for j in jobs:
-                data = {
-                    'scphost': request['scphost'],
-                    'scpuser': request['scpuser'],
-                    'params': params,
-                    'batches': j
-                }
-                p = sys.path[0].replace("/geode2/", "/N/")
-                
-                scriptbody = f"time apptainer run --nv {p}/hpc_python.sif {p}/hpc_whisper_server.py <<EOF\n"
-                scriptbody += json.dumps(data, indent=4) + "\n"
-                scriptbody += "EOF\n"
-                job_slot_time = int(target_slot_time * 1.5 / 60)
-                host_cpus = min([int(sconfig['cpu_threads']), host_cpus])
-                jobids.append(slurm.submit(scriptbody, email, gpu=gpus, cpu=host_cpus, job_time=job_slot_time, ram=host_ram, tag=params['engine']))
-        
-
-
-            print(json.dumps(jobids))
-
+                window = None
+                if backfill:
+                    partition = 'gpu_partition' if request['params']['device'] == 'cuda' else 'cpu_partition'
+                    window = slurm.backfill_window(config['slurm'].get(partition, 'gpu' if partition == 'gpu_partition' else 'general'))
+                plan = plan_whisper(request, config, overrides, acct, window)
+            if args.command == "plan" or args.dry_run:
+                return json.dumps(plan if args.command == "plan" and args.full else plan_summary(plan), indent=4)
+            elif config['slurm'].getboolean('pilot', False):
+                return json.dumps(submit_pilots(slurm, plan, request, email, config['slurm']))
+            else:
+                return json.dumps(submit_plan(slurm, plan, request, email, config['slurm']))
+        raise ValueError(f"Unknown function: {request['function']}")
 
-    
+    elif args.command == "accounting":
+        acct = Accounting(slurm)
+        acct.refresh(args.days)
+        summary = {}
+        for r in acct.records.values():
+            s = summary.setdefault(r['key'], {'jobs': 0, 'timeouts': 0, 'requested_hours': 0.0, 'used_hours': 0.0})
+            s['jobs'] += 1
+            s['timeouts'] += r['state'] == 'TIMEOUT'
+            s['requested_hours'] += r['requested']['job_time'] / 60
+            s['used_hours'] += r['elapsed'] / 3600
+        return json.dumps(summary, indent=4)
     elif args.command == "check":
-        print(json.dumps(slurm.get_job_info(args.id, active=True)))
+        return json.dumps(slurm.get_job_info(args.id, active=not args.all))
     elif args.command == "list":
-        print(json.dumps(slurm.get_job_info(active=True)))
+        return json.dumps(slurm.get_job_info(active=True))
     elif args.command == "cancel":
-        print(slurm.cancel_job(args.id))
+        return str(slurm.cancel_job(args.id))
+    elif args.command == "stage-check":
+        return json.dumps(stage_check(stage_dir(config), json.load(stdin_data)))
+    elif args.command == "wait":
+        if emit is None:
+            emit = lambda x: print(json.dumps(x), flush=True)
+        states = {}
+        for event in slurm.wait_jobs(args.id, args.interval, args.max_interval, timeout=args.timeout):
+            states[event['job_id']] = event['job_state']
+            emit(event)
+        # anything left didn't finish before the timeout
+        states.update({str(x): None for x in args.id if str(x) not in states})
+        return json.dumps(states)
+    raise ValueError(f"Unknown command: {args.command}")
+
+
+def serve(parser, config, slurm: Slurm):
+    """Run commands for a client over one connection.  Each line on stdin
+       is a request like {"id": 1, "argv": ["check", "1234"], "stdin": ...}
+       and a response like {"id": 1, "stdout": "...", "error": null} is
+       written for each one, in order.  Commands which report progress
+       also write {"id": 1, "event": {...}} lines before their response.
+       The configuration and the slurm cache are shared by all of the
+       requests in the session."""
+    out = sys.stdout
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        res = {'id': None, 'stdout': "", 'error': None}
+        try:
+            req = json.loads(line)
+            res['id'] = req.get('id')
+            # anything else that gets printed would corrupt the responses
+            with contextlib.redirect_stdout(sys.stderr):
+                args = parser.parse_args(req['argv'])
+                if args.command in (None, 'serve', 'results', 'stage'):
+                    raise ValueError(f"Cannot run {args.command} in a session")
+                res['stdout'] = run_command(args, config, slurm, req.get('stdin'),
+                                            lambda x: (out.write(json.dumps({'id': res['id'], 'event': x}) + "\n"), out.flush()))
+        except SystemExit:
+            # argparse has already said why on stderr
+            res['error'] = f"Bad arguments: {req.get('argv')}"
+        except Exception as e:
+            logging.exception(f"Request {res['id']} failed")
+            res['error'] = f"{type(e).__name__}: {e}"
+        out.write(json.dumps(res) + "\n")
+        out.flush()
+
+
+def main():
+    parser = build_parser()
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format="%(asctime)s [%(process)d:%(filename)s:%(lineno)d] [%(levelname)s] %(message)s")
+
+    # read the config
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    
+    slurm = Slurm(config['slurm']['account'], config['slurm']['batchdir'],
+                  cache_ttl=int(config['slurm'].get('squeue_cache_ttl', 30)),
+                  bindir=config['slurm'].get('slurm_bin', None))
+
+    if args.command == "serve":
+        serve(parser, config, slurm)
+    elif args.command == "results":
+        # the results are binary so they can't go through run_command.  The
+        # client says which results it already has on stdin.
+        have = sys.stdin.read().strip()
+        write_results(slurm, args.id, args.owner, json.loads(have) if have else {}, sys.stdout.buffer)
+    elif args.command == "stage":
+        print(json.dumps(stage_blobs(stage_dir(config), sys.stdin.buffer)))
+    elif args.command is not None:
+        print(run_command(args, config, slurm, sys.stdin.buffer if args.command in ("submit", "plan", "capacity", "stage-check") else None))
 
 
 if __name__ == "__main__":
@@ -2,11 +2,11 @@
 # run whisper on HPC for some local files.
 
 import argparse
-from hpc_client import HPCClient
+from hpc_client import HPCClient, extract_audio_tasks, silence_tasks
 import logging
 from pathlib import Path
-import time
 import json
+from stitch import stitch_directory
 
 def main():
     parser = argparse.ArgumentParser()
@@ -15,14 +15,23 @@ def main():
     parser.add_argument('outdir', type=Path, help="Output directory")
     parser.add_argument("--engine", choices=['whisper', 'faster_whisper'], default='whisper', help="Use whisper or faster_whisper")
     parser.add_argument('--model', default='medium', choices=['tiny', 'base', 'small', 'medium', 'large'], help="Whisper model")
-    parser.add_argument("--device", default='auto', choices=['cpu', 'cuda'], help="Computation device")
+    parser.add_argument("--device", default='auto', choices=['cpu', 'cuda', 'hybrid'], help="Computation device")
     parser.add_argument("--vad", default=False, action="store_true", help="Use VAD with faster_whisper")
+    parser.add_argument("--batch-size", type=int, default=1, help="Decode this many chunks of a file at once with faster_whisper")
+    parser.add_argument("--skip-silence", type=float, default=0, help="Don't transcribe silences of at least this many seconds")
+    parser.add_argument("--blankdetect", type=Path, default=None, help="Directory with the blankdetection results for --skip-silence")
     parser.add_argument("--language", type=str, default="en", help="Language")
     parser.add_argument("--hpcuser", type=str, default=None, help="User on HPC")
     parser.add_argument("--hpchost", type=str, default="bigred200.uits.iu.edu", help="HPC Host")
     parser.add_argument("--hpcscript", type=str, default="iu_hpc_processing/hpc_service.py")
     parser.add_argument("--scpuser", type=str, default=None, help="SCP User")
     parser.add_argument("--scphost", type=str, default=None, help="SCP File Host")
+    parser.add_argument("--waves", default=False, action="store_true", help="Start submitting jobs while the files are still being probed")
+    parser.add_argument("--extract-audio", choices=['flac', 'opus'], default=None, help="Send 16kHz mono audio extracted from the files instead of the files")
+    parser.add_argument("--stage", default=False, action="store_true", help="Copy the input files to HPC scratch before submitting")
+    parser.add_argument("--pull", default=False, action="store_true", help="Fetch the results from HPC instead of having them sent back")
+    parser.add_argument("--checksums", default=False, action="store_true", help="Verify the downloads on HPC with checksums")
+    parser.add_argument("--stream", default=False, action="store_true", help="Stream a compact, compressed submission (for large tasklists)")
     args = parser.parse_args()
     logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
                         format="%(asctime)s [%(process)d:%(filename)s:%(lineno)d] [%(levelname)s] %(message)s")
@@ -41,28 +50,41 @@ def main():
 
     hpc = HPCClient(connectuser=args.hpcuser, hpchost=args.hpchost, hpcscript=args.hpcscript,
                     scphost=args.scphost, scpuser=args.scpuser)
+    if args.blankdetect:
+        tasklist = silence_tasks(tasklist, args.blankdetect)
+    if args.extract_audio:
+        tasklist, files = extract_audio_tasks(tasklist, files, args.extract_audio)
+    if args.stage:
+        tasklist = hpc.stage(tasklist, files)
     subres = hpc.submit('whisper', {'engine': args.engine,
                                     'model': args.model, 
                                     'language': args.language,
                                     'device': args.device,
-                                    'vad': args.vad}, 
-                                    tasklist, files)
+                                    'vad': args.vad,
+                                    'batch_size': args.batch_size,
+                                    'skip_silence': args.skip_silence}, 
+                                    tasklist, files, stream=args.stream, compress=args.stream,
+                                    waves=args.waves, results='pull' if args.pull else 'push',
+                                    checksums=args.checksums)
     print(json.dumps(subres, indent=4))
-    jobids = set()
+    # the ids are strings on the HPC side, even when they look like numbers
+    jobids = {str(x) for x in subres}
     logging.info(f"These jobs were submitted: {jobids}")
 
     # wait for the jobs to complete
     logging.info("Waiting for jobs to complete...")
-    while jobids:
-        fin = set()
-        for j in jobids:
-            if not hpc.check(j):
-                logging.info(f"Job {j} completed")
-                fin.add(j)
-        jobids -= fin
-        if jobids:
-            time.sleep(20)
+    def finished(event):
+        logging.info(f"Job {event['job_id']} completed: {event['job_state']}")
+        if args.pull:
+            hpc.fetch_results(event['job_id'], args.outdir / ".hpc_results.json")
 
+    states = hpc.wait(sorted(jobids), finished)
+    failed = {k: v for k, v in states.items() if v != 'COMPLETED'}
+    if failed:
+        logging.warning(f"Some jobs did not complete: {failed}")
+
+    # put any files which were split across jobs back together
+    stitch_directory(args.outdir)
     logging.info("Finished!")
 
 
@@ -6,13 +6,27 @@ import getpass
 import whisper
 from faster_whisper import WhisperModel
 import torch
+import numpy as np
 import logging
-from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import multiprocessing.connection
+from multiprocessing import resource_tracker, shared_memory
+from queue import Queue, Empty
+import threading
 import argparse
+import dataclasses
+import bisect
+import itertools
 from pathlib import Path
 import subprocess
 from utils import write_outfile
+from taskqueue import TaskQueue
+from transfer import Downloader
 import os
+import hashlib
+import shutil
+import signal
 import time
 
 def main():
@@ -29,28 +43,282 @@ def main():
     # all of our job parameters come in via a json on stdin.
     data = json.load(sys.stdin)
 
-    # locate the scp keypair
-    if data['scpuser'] != getpass.getuser():
-        keyfile = Path.home() / f".ssh/{data['scpuser']}.id_rsa"
-    else:
-        keyfile = Path.home() / ".ssh/id_rsa"
+    server = None
+    if data.get('shared_model'):
+        # the workers only fetch and decode, and one process does all of
+        # the transcription.
+        server = ModelServer(data['params'], data['shared_model']['streams'])
+
+    if 'pilot' in data:
+        # pilot jobs pull their work from a queue until time runs out.
+        pilot = data['pilot']
+        deadline = time.time() + pilot['walltime']
+        workers = data['shared_model']['workers'] if server else pilot['workers']
+        ppe = ProcessPoolExecutor(workers)
+        logging.info(f"Starting {workers} pilot workers on {pilot['queue']}")
+        for _ in range(workers):
+            ppe.submit(do_pilot, pilot['queue'], data['params'], deadline, pilot.get('idle_timeout', 60),
+                       data.get('prefetch', 2), data.get('speculate', 0), server.client() if server else None)
+        ppe.shutdown(wait=True)
+        logging.info("Pilot workers have completed")
+        if server:
+            server.shutdown()
+        Scratch.sweep()
+        return
 
-    ppe = ProcessPoolExecutor(len(data['batches']))
-    logging.info("Submitting batches")
-    for b in data['batches']:
-        ppe.submit(do_whisper, b, data['params'], scphost=data['scphost'], scpuser=data['scpuser'], keyfile=keyfile)
+    # the batches only say how many workers there are:  all of the files go
+    # into one queue, longest first, and each worker takes the next one when
+    # it's ready, so they all finish at about the same time even if the
+    # planner's estimates were off.
+    queuedir = Path(f"queue-{os.environ['SLURM_ARRAY_TASK_ID']}" if 'SLURM_ARRAY_TASK_ID' in os.environ else "queue").absolute()
+    restarted = queuedir.exists()
+    queue = TaskQueue(queuedir)
+    if restarted:
+        # the job was requeued, so only the unfinished files need doing
+        for owner in queue.owners():
+            queue.requeue(owner)
+    else:
+        # pulled results are staged in the job directory instead of sent back
+        resultdir = str(Path("results").absolute()) if data.get('results', 'push') == 'pull' else None
+        for b in data['batches']:
+            for spec in b:
+                queue.enqueue({'scphost': data['scphost'], 'scpuser': data['scpuser'], 'params': {},
+                               'resultdir': resultdir, 'spec': spec},
+                              spec.get('predicted', spec.get('duration', 0)))
+    # slurm knows when the job has to end, otherwise go by the walltime we asked for
+    deadline = float(os.environ.get('SLURM_JOB_END_TIME', time.time() + data.get('walltime', 86400)))
+    workers = data['shared_model']['workers'] if server else len(data['batches'])
+    ppe = ProcessPoolExecutor(workers)
+    logging.info(f"Starting {workers} workers on {len(queue.pending())} files")
+    for _ in range(workers):
+        # the planner gave this job these files, so they're all tried
+        # whether they look like they'll fit or not.
+        ppe.submit(do_pilot, queuedir, data['params'], deadline, 0, data.get('prefetch', 2), data.get('speculate', 0),
+                   server.client() if server else None, fit=False)
     ppe.shutdown(wait=True)
     logging.info("Batches have completed")
+    if server:
+        server.shutdown()
+    Scratch.sweep()
+    # anything which was never started is a failure, not just a warning
+    unstarted = 0
+    while (claim := queue.claim("unstarted")[0]) is not None:
+        queue.finish(claim, False)
+        unstarted += 1
+    if unstarted:
+        logging.error(f"{unstarted} files were never started")
+        sys.exit(1)
+
+
+class Scratch:
+    """A process's directories for intermediate files on node-local storage.
+       Each file goes in the first place with room for it:  $TMPDIR, /tmp,
+       /dev/shm (which counts against the job's memory, so only for files
+       that are small next to what's free there), and finally the job
+       directory on the shared filesystem."""
+    BASES = (('TMPDIR', 1.0), ('/tmp', 1.0), ('/dev/shm', 0.1))
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.name = f"hpc_whisper-{os.environ.get('SLURM_JOB_ID', 'nojob')}-{self.pid}"
+        self.created = []
+
+
+    @classmethod
+    def bases(cls):
+        res = []
+        for base, fraction in cls.BASES:
+            base = os.environ.get(base) if not base.startswith("/") else base
+            if base and Path(base).is_dir() and base not in [x[0] for x in res]:
+                res.append((base, fraction))
+        return res
+
+
+    def path(self, filename: str, size=0):
+        """Get a path for a file of about size bytes"""
+        for base, fraction in self.bases():
+            try:
+                free = shutil.disk_usage(base).free
+            except OSError:
+                continue
+            if size * 1.1 + 64 * 1024 ** 2 > free * fraction:
+                continue
+            d = Path(base) / self.name
+            if d not in self.created:
+                try:
+                    d.mkdir(exist_ok=True)
+                except OSError:
+                    continue
+                self.created.append(d)
+            return d / filename
+        logging.warning(f"No room for {filename} ({size} bytes) on local storage, using the job directory")
+        return Path(filename).absolute()
+
+
+    def cleanup(self):
+        for d in self.created:
+            shutil.rmtree(d, ignore_errors=True)
+        self.created = []
+
+
+    @classmethod
+    def sweep(cls):
+        """Remove anything left by this job's processes that didn't get to
+           clean up after themselves"""
+        for base, _ in cls.bases():
+            for d in Path(base).glob(f"hpc_whisper-{os.environ.get('SLURM_JOB_ID', 'nojob')}-*"):
+                shutil.rmtree(d, ignore_errors=True)
 
 
-def do_whisper(todo: list, params: dict, scphost='localhost', scpuser=None, keyfile=None):   
-    device = params['device'] if params['device'] != 'auto' else ('cuda' if torch.cuda_is_available() else 'cpu')    
+_scratch = None
+
+def scratch():
+    """The scratch space for this process"""
+    global _scratch
+    if _scratch is None or _scratch.pid != os.getpid():
+        _scratch = Scratch()
+    return _scratch
+
+
+def find_keyfile(scpuser):
+    """Locate the scp keypair"""
+    if scpuser != getpass.getuser():
+        return Path.home() / f".ssh/{scpuser}.id_rsa"
+    else:
+        return Path.home() / ".ssh/id_rsa"
+
+
+def get_device(params):
+    return params['device'] if params['device'] != 'auto' else ('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def load_model(params, streams=1):
+    """Load the model for the parameters, returning the device and model.
+       A faster_whisper model can run streams transcriptions at once."""
+    device = get_device(params)
     logging.info(f"Using {params['model']} on computation device {device} with engine {params['engine']}")
     if params['engine'] == 'whisper':
         model = whisper_load_model(params['model'], device)
     else:
-        model = faster_whisper_load_model(params['model'], device)
+        model = faster_whisper_load_model(params['model'], device, streams)
+    return device, model
+
+
+class ModelServer:
+    """One process which owns the model for the whole job, so it's only
+       loaded once no matter how many workers there are.  The workers put
+       the decoded audio in shared memory and queue a request with its name,
+       and the server works on up to streams of them at once so the device
+       always has the next file ready."""
+    def __init__(self, params, streams=1):
+        # the workers and the server have to share a resource tracker or
+        # the buffers the server attaches to look like leaks.
+        resource_tracker.ensure_running()
+        self.streams = streams
+        self.stopping = False
+        self.manager = multiprocessing.Manager()
+        self.requests = self.manager.Queue()
+        # has the error if the server couldn't load the model or has died
+        self.status = self.manager.dict()
+        self.process = multiprocessing.Process(target=serve_model, args=(params, self.requests, streams, self.status),
+                                               daemon=True)
+        self.process.start()
+        threading.Thread(target=self._watch, daemon=True).start()
+
+
+    def _watch(self):
+        """Tell the workers if the server goes away while they need it"""
+        multiprocessing.connection.wait([self.process.sentinel])
+        if not self.stopping:
+            logging.error("The model server has stopped unexpectedly")
+            self.status.setdefault('error', "The model server has stopped unexpectedly")
+
 
+    def client(self):
+        """A client for one worker, with its own reply queue"""
+        return ModelClient(self.requests, self.manager.Queue(), self.status)
+
+
+    def shutdown(self):
+        self.stopping = True
+        for _ in range(self.streams):
+            self.requests.put(None)
+        self.process.join()
+        self.manager.shutdown()
+
+
+class ModelClient:
+    def __init__(self, requests, replies, status, poll=10):
+        self.requests = requests
+        self.replies = replies
+        self.status = status
+        self.poll = poll
+
+
+    def transcribe(self, audio, spec, params):
+        """Transcribe audio on the model server, returning the results"""
+        if 'error' in self.status:
+            raise RuntimeError(self.status['error'])
+        shm = shared_memory.SharedMemory(create=True, size=max(1, audio.nbytes))
+        try:
+            np.ndarray(audio.shape, dtype=np.float32, buffer=shm.buf)[:] = audio
+            self.requests.put((shm.name, len(audio), spec, params, self.replies))
+            while True:
+                try:
+                    ok, results = self.replies.get(timeout=self.poll)
+                    break
+                except Empty:
+                    # don't wait forever on a server that isn't there
+                    if 'error' in self.status:
+                        raise RuntimeError(self.status['error'])
+        finally:
+            shm.close()
+            shm.unlink()
+        if not ok:
+            raise RuntimeError(f"Model server failed: {results}")
+        return results
+
+
+def serve_model(params, requests, streams=1, status=None):
+    """Run the transcription requests from the workers until each stream
+       gets a None.  If the model can't be loaded, the error goes in status
+       so the workers fail their files instead of waiting."""
+    try:
+        device, model = load_model(params, streams)
+    except Exception as e:
+        logging.exception(f"Cannot load the model: {e}")
+        if status is not None:
+            status['error'] = f"Cannot load the model: {e}"
+        return
+
+    def stream():
+        while (request := requests.get()) is not None:
+            name, length, spec, rparams, reply = request
+            shm = None
+            try:
+                shm = shared_memory.SharedMemory(name=name)
+                audio = np.ndarray((length,), dtype=np.float32, buffer=shm.buf)
+                if rparams['engine'] == 'whisper':
+                    reply.put((True, whisper_impl(audio, spec, model, device, rparams)))
+                else:
+                    reply.put((True, faster_whisper_impl(audio, spec, model, device, rparams)))
+            except Exception as e:
+                logging.exception(f"Exception during whisper for {spec['infile']}: {e}")
+                reply.put((False, str(e)))
+            finally:
+                audio = None
+                if shm is not None:
+                    shm.close()
+
+    threads = [threading.Thread(target=stream) for _ in range(streams)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def connect_sftp(scphost, scpuser, keyfile):
+    """Connect back to the file host"""
     try:
         ssh = paramiko.SSHClient()
         ssh.load_system_host_keys()
@@ -58,77 +326,431 @@ def do_whisper(todo: list, params: dict, scphost='localhost', scpuser=None, keyf
         #key = paramiko.PKey().from_private_key_file(str(keyfile))
         key = paramiko.RSAKey(filename=str(keyfile))
         ssh.connect(scphost, username=scpuser, pkey=key)
-        sftp = ssh.open_sftp()
+        return ssh.open_sftp()
     except Exception as e:
         logging.exception(f"host: {scphost}, user: {scpuser}, keyname: {keyfile}")
         raise e
 
-    logging.info(f"Connected via sftp: {sftp!s}, todo: {todo}")
-    pid = os.getpid()
-    for spec in todo:
-        logging.info(f"Processing {spec}")
+
+def do_pilot(queuedir, params: dict, deadline: float, idle_timeout=60, prefetch=2, speculate=0, model=None, fit=True):
+    """Process tasks from the queue until there's nothing left or the
+       remaining time isn't enough for any of them (or until the deadline,
+       taking any task, if fit is False).  If speculate is set,
+       a worker with nothing else to do also runs a copy of any task
+       that has taken more than speculate times its predicted cost.  The
+       model is a ModelClient for the job's model server, otherwise the
+       worker loads its own."""
+    if model is None:
+        device, model = load_model(params)
+    else:
+        device = get_device(params)
+    queue = TaskQueue(queuedir)
+    owner = f"{os.environ.get('SLURM_JOB_ID', 'nojob')}.{os.getpid()}"
+    connections = {}
+
+    def claims():
+        # leave some time to send the results back
+        safety = 1.25
+        idle_since = time.time()
+        while time.time() < deadline:
+            claim, entry = queue.claim(owner, max_cost=(deadline - time.time()) / safety if fit else None)
+            done = lambda ok, claim=claim: queue.finish(claim, ok)
+            if claim is None and speculate:
+                claim, entry = queue.speculate(owner, speculate, max_cost=(deadline - time.time()) / safety)
+                if claim is not None:
+                    logging.info(f"Running a speculative copy of {claim}")
+                    # a failed copy mustn't fail the task while the original is still going
+                    done = lambda ok, claim=claim: ok and queue.finish(claim, True)
+            if claim is None:
+                if time.time() - idle_since > idle_timeout and not (speculate and queue.claimed()):
+                    logging.info("No tasks left that fit in the remaining time")
+                    break
+                time.sleep(5)
+                continue
+            task = entry['task']
+            scp = (task['scphost'], task['scpuser'])
+            if scp not in connections:
+                keyfile = find_keyfile(task['scpuser'])
+                connections[scp] = Downloader(connect_sftp(*scp, keyfile),
+                                              connect=lambda scp=scp, keyfile=keyfile: connect_sftp(*scp, keyfile))
+            yield task['spec'], {'downloader': connections[scp], 'params': dict(params, **task['params']),
+                                 'scphost': scp[0], 'scpuser': scp[1], 'resultdir': task.get('resultdir'),
+                                 'done': done}
+            idle_since = time.time()
+
+    run_pipeline(claims(), model, device, prefetch)
+
+
+def run_pipeline(work, model, device, prefetch=2):
+    """Transcribe the (spec, context) pairs from work.  A background thread
+       fetches and decodes up to prefetch files ahead of the one being
+       transcribed and the results are sent back in another, so the model
+       doesn't wait for I/O unless the fetching can't keep up.  The context
+       has the downloader, params, scphost, scpuser, resultdir and an
+       optional done callback which is given whether the file succeeded."""
+    ready = Queue(maxsize=prefetch)
+    # slurm sends a TERM at the time limit, which should clean up on the
+    # way out instead of leaving the intermediates on the node.
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(1))
+
+    def fetcher():
         try:
-            logging.info(f"Retrieving {spec['infile']}")
-            with open(f"media-{pid}.mp4", "wb") as o:
-                with sftp.open(spec['infile'], "rb") as i:
-                    while len(data := i.read()) > 0:
-                        o.write(data)
-            
-            logging.info(f"Normalizing audio")
-            p = subprocess.run(['ffmpeg', '-i', f'media-{pid}.mp4', 
-                                '-r', '44100', '-ac', '1', '-c:a', 'pcm_s16le', 
-                                f'audio-{pid}.wav'], stdin=subprocess.DEVNULL, 
-                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                                encoding='utf-8')
-            if p.returncode != 0:
-                raise Exception(f"Cannot run ffmpeg on {spec['infile']}: {p.stdout}")
+            for n, (spec, context) in enumerate(work):
+                ready.put((fetch_spec(spec, context['downloader'], n), context))
+        except Exception as e:
+            logging.exception(f"Cannot get more work: {e}")
+        finally:
+            ready.put(None)
 
+    threading.Thread(target=fetcher, daemon=True).start()
+    sender = ThreadPoolExecutor(1)
+    timings = []
+    try:
+        while True:
             t = time.time()
-            if params['engine'] == 'whisper':
-                results = whisper_impl(pid, spec, model, device, params)
+            item = ready.get()
+            if item is None:
+                break
+            job, context = item
+            # time that the model sat waiting for the fetcher
+            job['timings']['wait'] = time.time() - t
+            if 'error' not in job and transcribe_job(job, model, device, context):
+                sender.submit(send_job, job, context)
             else:
-                results = faster_whisper_impl(pid, spec, model, device, params)
-            runtime = time.time() - t
-            
-            # inject the job parameters and whatnot into the results.
-            results['_job'] = {
-                'runtime': runtime,
-                'media_duration': spec['duration'],
-                'job_name': os.environ.get('SLURM_JOB_NAME', 'no job name'),
-                'job_id': os.environ.get('SLURM_JOB_ID', 'no job id'),
-                'params': params,
-                'infile': spec['infile'],
-                'outfile': spec['outfile'],
-                'scp_callback': f"{scpuser}@{scphost}"
-            }
-
-
-            with open(f"transcript-{pid}.json", "w") as f:
-                json.dump(results, f, indent=4)            
-            
-            logging.info(f"{spec['infile']}: {params['engine']} {params['model']} Transcription finished, {spec['duration']} seconds of content in {runtime} seconds, content ratio {spec['duration'] / runtime}")    
-            
-            with sftp.open(spec['outfile'], 'w') as o:
-                with open(f"transcript-{pid}.json", "r") as i:
+                finish_job(job, context, False)
+            timings.append(job['timings'])
+        sender.shutdown(wait=True)
+    finally:
+        scratch().cleanup()
+    totals = {}
+    for x in timings:
+        for k, v in x.items():
+            totals[k] = totals.get(k, 0) + v
+    logging.info(f"Processed {len(timings)} files, total seconds per stage: { {k: round(v, 1) for k, v in totals.items()} }")
+
+
+def fetch_spec(spec, downloader: Downloader, n: int):
+    """Get a file and decode its audio, returning the job for the
+       transcription.  The job has an error if something went wrong."""
+    tag = f"{os.getpid()}-{n}"
+    job = {'spec': spec, 'media': None, 'audio': None, 'transcript': str(scratch().path(f"transcript-{tag}.json")),
+           'timings': {}}
+    logging.info(f"Processing {spec}")
+    try:
+        t = time.time()
+        if spec.get('staged'):
+            # it's already on the cluster filesystem
+            job['audio'] = decode_audio(spec, spec['infile'])
+        else:
+            try:
+                job['audio'] = decode_audio(spec, downloader=downloader)
+            except Exception as e:
+                # some containers (mp4 with the index at the end) can't be
+                # decoded without seeking, so they have to be downloaded.
+                logging.info(f"Cannot stream {spec['infile']}, downloading it instead: {e}")
+                job['media'] = fetch_media(spec, downloader)
+                job['timings']['fetch'] = time.time() - t
+                t = time.time()
+                job['audio'] = decode_audio(spec, job['media'])
+        job['timings']['decode'] = time.time() - t
+    except Exception as e:
+        logging.exception(f"Exception while fetching {spec['infile']}: {e}")
+        job['error'] = str(e)
+    finally:
+        # a failed download leaves its partial file for the next try
+        remove_files(job['media'])
+    return job
+
+
+def fetch_media(spec, downloader: Downloader, attempts=3):
+    """Download a file into scratch, returning where it is.  The partial
+       download is named for the file so each attempt picks up where the
+       last one stopped, and a dropped connection is made again."""
+    name = f"media-{hashlib.sha1(spec['infile'].encode('utf-8')).hexdigest()}{Path(spec['infile']).suffix}"
+    media = None
+    for attempt in range(attempts):
+        try:
+            downloader.reconnect()
+            if media is None:
+                media = scratch().path(name, downloader.sftp.stat(spec['infile']).st_size)
+            downloader.download(spec['infile'], media, spec.get('sha256'))
+            return str(media)
+        except Exception as e:
+            if attempt == attempts - 1:
+                raise
+            logging.warning(f"Downloading {spec['infile']} failed, trying again: {e}")
+            time.sleep(2 ** attempt)
+
+
+def decode_audio(spec, source=None, downloader: Downloader=None):
+    """Decode the audio of a file into 16kHz mono float32 samples, which is
+       what both engines want.  If there's no local source, the remote file
+       is streamed into ffmpeg, so nothing is written to disk either way."""
+    # parts of a split file only need their own time range
+    trim = ['-ss', str(spec['start']), '-t', str(spec['duration'])] if 'part' in spec else []
+    p = subprocess.Popen(['ffmpeg', '-loglevel', 'error', *trim, '-i', source or 'pipe:0',
+                          '-vn', '-ac', '1', '-ar', '16000', '-f', 'f32le', 'pipe:1'],
+                         stdin=subprocess.PIPE if source is None else subprocess.DEVNULL,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    errors = []
+    stderr = []
+    threads = [threading.Thread(target=lambda: stderr.append(p.stderr.read().decode('utf-8', errors='replace')))]
+    if source is None:
+        threads.append(threading.Thread(target=feed_ffmpeg, args=(p.stdin, downloader.sftp, spec, errors)))
+    for x in threads:
+        x.start()
+
+    # the whole thing is read into one buffer which is about the right size
+    audio = np.empty(int((spec['duration'] + 1) * 16000), dtype=np.float32)
+    view = memoryview(audio).cast('B')
+    count = 0
+    while True:
+        if count == len(view):
+            bigger = np.empty(len(audio) * 3 // 2 + 16000, dtype=np.float32)
+            bigger[:len(audio)] = audio
+            audio = bigger
+            view = memoryview(audio).cast('B')
+        n = p.stdout.readinto(view[count:])
+        if not n:
+            break
+        count += n
+    p.wait()
+    for x in threads:
+        x.join()
+    if p.returncode != 0 or errors:
+        raise Exception(f"Cannot decode {spec['infile']}: {' '.join(errors + stderr)}")
+    return audio[:count // 4]
+
+
+# how much of a remote file is requested ahead of ffmpeg.  This is what
+# each worker holds while decoding, whatever the size of the file.
+FEED_WINDOW = 16 * 1024 * 1024
+FEED_CHUNK = 1024 * 1024
+
+
+def feed_ffmpeg(stdin, sftp, spec, errors):
+    """Copy the remote file into ffmpeg's stdin, checking the checksum if
+       there is one and ffmpeg reads the whole thing.  The file is read a
+       window at a time so a slow ffmpeg doesn't leave the whole file
+       buffered in memory."""
+    h = hashlib.sha256()
+    try:
+        with sftp.open(spec['infile'], "rb") as f:
+            size = f.stat().st_size
+            for start in range(0, size, FEED_WINDOW):
+                end = min(size, start + FEED_WINDOW)
+                for data in f.readv([(x, min(FEED_CHUNK, end - x)) for x in range(start, end, FEED_CHUNK)]):
+                    h.update(data)
+                    stdin.write(data)
+        if spec.get('sha256') and h.hexdigest() != spec['sha256']:
+            errors.append(f"Checksum mismatch for {spec['infile']}")
+    except BrokenPipeError:
+        # ffmpeg has what it needs
+        pass
+    except Exception as e:
+        errors.append(str(e))
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def remove_files(*files):
+    for f in files:
+        if f is not None:
+            for x in (f, f"{f}.part", f"{f}.part.json"):
+                Path(x).unlink(missing_ok=True)
+
+
+def transcribe_job(job, model, device, context):
+    """Transcribe a fetched file into its transcript file, returning
+       whether it was successful"""
+    spec = job['spec']
+    params = context['params']
+    try:
+        audio = job['audio']
+        regions = None
+        if params.get('skip_silence'):
+            # only the audio between the long silences is transcribed
+            t = time.time()
+            regions = speech_regions(audio, spec, params['skip_silence'])
+            audio = np.concatenate([audio[a:b] for a, b in regions]) if regions else audio[:0]
+            job['timings']['silence'] = time.time() - t
+            logging.info(f"{spec['infile']}: {len(audio) / 16000:0.1f}s of speech in {len(regions)} regions out of {spec['duration']:0.1f}s")
+
+        t = time.time()
+        if regions is not None and len(audio) < 16000:
+            # nothing worth transcribing
+            results = {'text': '', 'segments': [], 'language': params['language']}
+        elif isinstance(model, ModelClient):
+            results = model.transcribe(audio, spec, params)
+        elif params['engine'] == 'whisper':
+            results = whisper_impl(audio, spec, model, device, params)
+        else:
+            results = faster_whisper_impl(audio, spec, model, device, params)
+        runtime = time.time() - t
+        job['timings']['transcribe'] = runtime
+        if regions:
+            remap_timestamps(results, regions)
+        if 'part' in spec:
+            offset_timestamps(results, spec['start'])
+        
+        # inject the job parameters and whatnot into the results.
+        results['_job'] = {
+            'runtime': runtime,
+            'media_duration': spec['duration'],
+            'media_type': spec.get('media_type', 'unknown'),
+            'device': device,
+            'job_name': os.environ.get('SLURM_JOB_NAME', 'no job name'),
+            'job_id': os.environ.get('SLURM_JOB_ID', 'no job id'),
+            'params': params,
+            'infile': spec['infile'],
+            'outfile': spec['outfile'],
+            'scp_callback': f"{context['scpuser']}@{context['scphost']}",
+            'timings': dict(job['timings']),
+        }
+        if regions is not None:
+            results['_job']['speech_duration'] = len(audio) / 16000
+        if 'part' in spec:
+            results['_job']['part'] = dict(spec['part'], start=spec['start'], end=spec['end'])
+
+
+        with open(job['transcript'], "w") as f:
+            json.dump(results, f, indent=4)            
+        
+        logging.info(f"{spec['infile']}: {params['engine']} {params['model']} Transcription finished, {spec['duration']} seconds of content in {runtime} seconds, content ratio {spec['duration'] / max(runtime, 0.001)}")    
+        return True
+
+    except Exception as e:
+        logging.exception(f"Exception during whisper for {spec['infile']}: {e}")
+        return False
+
+    finally:
+        # the audio isn't needed any more, whatever happened
+        job['audio'] = None
+        audio = None
+
+
+def send_job(job, context):
+    """Send the transcript back, or stage it if there's a result directory"""
+    spec = job['spec']
+    ok = False
+    try:
+        t = time.time()
+        if context.get('resultdir'):
+            staged = stage_result(job['transcript'], context['resultdir'], f"{context['scpuser']}@{context['scphost']}",
+                                  spec['outfile'])
+            logging.info(f"{spec['outfile']} has been staged as {staged}")
+        else:
+            with context['downloader'].sftp.open(spec['outfile'], 'w') as o:
+                with open(job['transcript'], "r") as i:
                     while len(data := i.read()) > 0:
                         o.write(data)
-                        
             logging.info(f"{spec['outfile']} has been transferred back")
+        job['timings']['send'] = time.time() - t
+        ok = True
+    except Exception as e:
+        logging.exception(f"Exception while sending {spec['outfile']}: {e}")
+    finish_job(job, context, ok)
 
-        except Exception as e:
-            logging.exception(f"Exception during whisper for {spec['infile']}: {e}")
 
-        finally:
-            for f in (f'media-{pid}.mp4', f'audio-{pid}.wav', f'transcript-{pid}.json'):
-                Path(f).unlink(missing_ok=True)
+def finish_job(job, context, ok):
+    """Clean up after a job and tell whoever needs to know how it went"""
+    job['audio'] = None
+    remove_files(job['transcript'])
+    if context.get('done'):
+        context['done'](ok)
+
+
+def stage_result(transcript, resultdir, owner, outfile):
+    """Move a transcript into the owner's result directory, named for its
+       outfile.  It's renamed into place so a fetch never sees part of it."""
+    d = Path(resultdir) / owner
+    d.mkdir(parents=True, exist_ok=True)
+    name = hashlib.sha1(outfile.encode('utf-8')).hexdigest() + ".json"
+    tmpfile = d / f".{name}.{os.getpid()}"
+    shutil.move(transcript, tmpfile)
+    os.replace(tmpfile, d / name)
+    return d / name
+
+
+def offset_timestamps(results, offset):
+    """Move the segment and word timestamps of a partial transcript to the
+       timeline of the whole file"""
+    for seg in results['segments']:
+        seg['start'] += offset
+        seg['end'] += offset
+        for w in seg.get('words', []):
+            w['start'] += offset
+            w['end'] += offset
+
+
+def speech_regions(audio, spec, min_silence, rate=16000, pad=0.5):
+    """The sample ranges of the audio to transcribe:  everything except the
+       silences of at least min_silence seconds, less pad seconds at each end
+       so the words next to them aren't clipped.  The silences come from the
+       spec (from blank detection, on the timeline of the whole file) or are
+       found in the audio if it doesn't have any."""
+    if 'silence' in spec:
+        offset = spec.get('start', 0)
+        silences = [(s - offset, e - offset) for s, e in spec['silence'] if e - s >= min_silence]
+    else:
+        silences = find_silences(audio, min_silence, rate)
+    regions = []
+    pos = 0
+    for s, e in sorted(silences):
+        s = min(len(audio), int(max(0, s + pad) * rate))
+        e = min(len(audio), int(max(0, e - pad) * rate))
+        if e <= s:
+            continue
+        if s > pos:
+            regions.append((pos, s))
+        pos = max(pos, e)
+    if pos < len(audio):
+        regions.append((pos, len(audio)))
+    return regions
+
+
+def find_silences(audio, min_silence, rate=16000, threshold=-60):
+    """Find the spans of at least min_silence seconds where the level stays
+       below threshold dB, the same as blankdetection's silencedetect, in
+       tenths of a second"""
+    frame = rate // 10
+    n = len(audio) // frame
+    if n == 0:
+        return []
+    rms = np.sqrt(np.mean(np.square(audio[:n * frame].reshape(n, frame)), axis=1))
+    quiet = np.concatenate(([False], rms < 10 ** (threshold / 20), [False]))
+    edges = np.flatnonzero(np.diff(quiet.astype(np.int8)))
+    return [(int(s) / 10, int(e) / 10) for s, e in zip(edges[0::2], edges[1::2]) if (e - s) / 10 >= min_silence]
+
+
+def remap_timestamps(results, regions, rate=16000):
+    """Move the segment and word timestamps of a transcript of the regions
+       joined together to where they are in the audio"""
+    joined = list(itertools.accumulate((b - a) / rate for a, b in regions[:-1]))
+    joined.insert(0, 0.0)
+
+    def remap(t, end=False):
+        # a time on a join is the end of one region or the start of the next
+        i = (bisect.bisect_left(joined, t) if end else bisect.bisect_right(joined, t)) - 1
+        i = max(0, i)
+        return regions[i][0] / rate + t - joined[i]
+
+    for seg in results['segments']:
+        seg['start'] = remap(seg['start'])
+        seg['end'] = remap(seg['end'], True)
+        for w in seg.get('words', []):
+            w['start'] = remap(w['start'])
+            w['end'] = remap(w['end'], True)
 
 
 def whisper_load_model(model, device):
     return whisper.load_model(model, device=device, download_root="/var/lib/whisper")
 
 
-def whisper_impl(pid, spec, model_data, device, params):
-    audio = whisper.load_audio(f"audio-{pid}.wav")
+def whisper_impl(audio, spec, model_data, device, params):
     if params['language'] == "auto":            
         logging.info(f"{spec['infile']}: Detecting language...")              
         # Just pull the first few languages that are in tokeniser.py
@@ -146,22 +768,34 @@ def whisper_impl(pid, spec, model_data, device, params):
     return res
 
 
-def faster_whisper_load_model(model, device):
+def faster_whisper_load_model(model, device, workers=1):
     if device == 'cuda':
         ctype = 'float16'
         threads = 4
     else:
         ctype = 'float32'
         threads = 16
-    logging.info(f"Loading faster_whisper model: {model}, {device}, {ctype}, {threads}")
-    return WhisperModel(model, device=device, compute_type=ctype, cpu_threads=threads) #, download_dir="/var/lib/faster_whisper")
+    logging.info(f"Loading faster_whisper model: {model}, {device}, {ctype}, {threads}, {workers} workers")
+    return WhisperModel(model, device=device, compute_type=ctype, cpu_threads=threads, num_workers=workers) #, download_dir="/var/lib/faster_whisper")
 
 
-def faster_whisper_impl(pid, spec, model_data, device, params):    
-    segiter, info = model_data.transcribe(f"audio-{pid}.wav", word_timestamps=True, language=params['language'], vad_filter=params['vad'])
+def faster_whisper_impl(audio, spec, model_data, device, params):    
+    if params.get('batch_size', 1) > 1:
+        # the audio is cut into chunks at the pauses found by the vad, or
+        # into fixed windows without it, and the chunks are decoded
+        # batch_size at a time.  The segments come back on the timeline of
+        # the whole file.  It's only in faster_whisper 1.1 and later.
+        from faster_whisper import BatchedInferencePipeline
+        clips = None if params['vad'] else fixed_windows(len(audio))
+        segiter, info = BatchedInferencePipeline(model=model_data).transcribe(audio, batch_size=params['batch_size'],
+                                                                              word_timestamps=True, language=params['language'],
+                                                                              vad_filter=params['vad'], clip_timestamps=clips)
+    else:
+        segiter, info = model_data.transcribe(audio, word_timestamps=True, language=params['language'], vad_filter=params['vad'])
     logging.info(f"Using language {info.language}")
     res = {
-        'faster_whisper_info': info,
+        # it's a dataclass from 1.1 on, which json can't handle
+        'faster_whisper_info': dataclasses.asdict(info) if dataclasses.is_dataclass(info) else info,
         'language': info.language,
         'text': '',
         'segments': []
@@ -188,5 +822,10 @@ def faster_whisper_impl(pid, spec, model_data, device, params):
     return res
 
 
+def fixed_windows(samples: int, window=30, rate=16000):
+    """Split audio into window second chunks, as sample offsets"""
+    return [{'start': s, 'end': min(samples, s + window * rate)} for s in range(0, max(1, samples), window * rate)]
+
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,189 @@
+# Batch planning for HPC submissions
+#
+# A plan is a list of jobs, each job is a list of batches (one per concurrent
+# slot in the job), and each batch is a list of task specs.  The planners
+# work in predicted processing seconds which come from a cost function
+# applied to each task.
+import heapq
+import logging
+from math import ceil
+
+
+def plan_greedy(tasks: list[dict], capacity: float, concurrent_batches: int, cost):
+    """Fill batches in tasklist order, starting a new batch when the current
+       one would overflow.  This is the original hpc_service behavior."""
+    batches = [[]]
+    batch_sizes = [0.0]
+    for t in tasks:
+        c = cost(t)
+        if batch_sizes[-1] + c > capacity:
+            # only start a new one if there's something already in this batch
+            if len(batches[-1]) > 0:
+                batches.append([])
+                batch_sizes.append(0.0)
+        batch_sizes[-1] += c
+        batches[-1].append(t)
+    if not batches[-1]:
+        batches.pop()
+    return [batches[i:i+concurrent_batches] for i in range(0, len(batches), concurrent_batches)]
+
+
+def plan_lpt(tasks: list[dict], capacity: float, concurrent_batches: int, cost):
+    """Longest-processing-time-first packing.
+
+       The number of slots is the smallest multiple of concurrent_batches
+       that can hold the content without overflowing capacity, the tasks
+       are placed longest-first onto the least loaded slot, and then the
+       slots are grouped into jobs so that the slots in a job have similar
+       loads.  Within a slot the tasks are ordered longest-first."""
+    if not tasks:
+        return []
+    costed = sorted(((cost(t), n, t) for n, t in enumerate(tasks)), key=lambda x: (-x[0], x[1]))
+    total = sum(c for c, _, _ in costed)
+    # anything larger than capacity gets a slot to itself, so there have to
+    # be at least that many slots in addition to the ones for everything else.
+    oversize = sum(1 for c, _, _ in costed if c > capacity)
+    rest = sum(c for c, _, _ in costed if c <= capacity)
+    slot_count = max(1, oversize + ceil(rest / capacity))
+    job_count = ceil(slot_count / concurrent_batches)
+    while True:
+        slot_count = min(job_count * concurrent_batches, len(costed))
+        slots = _lpt_assign(costed, slot_count)
+        if all(load <= capacity or len(batch) == 1 for load, batch in slots):
+            break
+        job_count += 1
+
+    # similar slots go together so one short slot doesn't share a job with
+    # a long one.
+    slots.sort(key=lambda x: -x[0])
+    batches = [batch for _, batch in slots if batch]
+    logging.debug(f"LPT packed {len(costed)} tasks with {total:0.1f}s of predicted work into {len(batches)} slots")
+    return [batches[i:i+concurrent_batches] for i in range(0, len(batches), concurrent_batches)]
+
+
+def _lpt_assign(costed, slot_count):
+    """Place the (cost, order, task) tuples onto the least loaded slot"""
+    heap = [(0.0, n) for n in range(slot_count)]
+    slots = [[0.0, []] for _ in range(slot_count)]
+    for c, _, t in costed:
+        load, n = heapq.heappop(heap)
+        slots[n][0] += c
+        slots[n][1].append(t)
+        heapq.heappush(heap, (slots[n][0], n))
+    return slots
+
+
+def split_task(task: dict, capacity: float, cost, overlap=30.0):
+    """Split a task that is predicted to take longer than capacity into
+       time-ranged parts which overlap by a few seconds so the words at the
+       boundaries aren't lost.  Each part has its own outfile and a 'part'
+       record which is used when stitching the results back together."""
+    c = cost(task)
+    if c <= capacity or task['duration'] <= 2 * overlap:
+        return [task]
+    count = ceil(c / capacity)
+    length = task['duration'] / count
+    parts = []
+    for n in range(count):
+        start = max(0.0, n * length - overlap / 2)
+        end = min(task['duration'], (n + 1) * length + overlap / 2)
+        p = dict(task)
+        p.update({
+            'start': start,
+            'end': end,
+            'duration': end - start,
+            'outfile': f"{task['outfile']}.part{n:03d}",
+            'part': {'index': n, 'count': count, 'outfile': task['outfile'],
+                     'media_duration': task['duration']}
+        })
+        parts.append(p)
+    logging.info(f"Split {task['infile']} ({task['duration']:0.1f}s) into {count} parts of {length:0.1f}s")
+    return parts
+
+
+def split_hybrid(tasks: list[dict], gpu: dict, cpu: dict):
+    """Divide the tasks between GPU and CPU jobs.  Each side is a dict with
+       the cost function, the expected queue wait, the plan function which
+       returns the predicted makespans of the jobs it would plan for a list
+       of tasks, and the number of jobs which can run at once.  The
+       shortest files are moved from the GPU side to the CPU side as long
+       as that brings the predicted finish time of the whole set down, and
+       a file is never moved if it alone would take longer on the CPU than
+       the GPU side has left."""
+    sides = {'cuda': gpu, 'cpu': cpu}
+    ordered = sorted(tasks, key=lambda t: t['duration'])
+    finishes = {}
+
+    def finish(moved):
+        # the finish times of each side with the first moved files on the CPU
+        if moved not in finishes:
+            parts = {'cpu': ordered[:moved], 'cuda': ordered[moved:]}
+            finishes[moved] = {d: _side_finish(sides[d], parts[d]) for d in sides}
+        return finishes[moved]
+
+    # the CPU side only gets slower and the GPU side only gets faster as
+    # files are moved, so the best split is next to where they cross.
+    low, high = 0, len(ordered)
+    while low < high:
+        mid = (low + high) // 2
+        if finish(mid)['cpu'] >= finish(mid)['cuda']:
+            high = mid
+        else:
+            low = mid + 1
+    moved = low
+    if moved > 0:
+        before = finish(moved - 1)
+        single = cpu['wait'] + cpu['cost'](ordered[moved - 1])
+        if single > before['cuda'] or max(finish(moved).values()) >= max(before.values()):
+            moved -= 1
+
+    return {'cpu': ordered[:moved],
+            'cuda': ordered[moved:],
+            'finish': finish(moved)}
+
+
+def _side_finish(side: dict, tasks: list[dict]):
+    """When one side of a hybrid split is predicted to finish, with its
+       planned jobs running at most side['jobs'] at a time"""
+    if not tasks:
+        return 0.0
+    makespans = [(m, n, None) for n, m in enumerate(sorted(side['plan'](tasks), reverse=True))]
+    lanes = _lpt_assign(makespans, max(1, min(side['jobs'], len(makespans))))
+    return side['wait'] + max(load for load, _ in lanes)
+
+
+PLANNERS = {
+    'greedy': plan_greedy,
+    'lpt': plan_lpt,
+}
+
+
+def plan_batches(tasks: list[dict], capacity: float, concurrent_batches: int, cost, policy="lpt"):
+    """Plan the tasks into jobs of concurrent batches using the named policy"""
+    if policy not in PLANNERS:
+        raise ValueError(f"Unknown planner policy {policy}, must be one of {list(PLANNERS.keys())}")
+    return PLANNERS[policy](tasks, capacity, concurrent_batches, cost)
+
+
+def predict_makespan(jobs: list[list[list[dict]]], cost, cost_p95=None):
+    """Return the predicted per-slot and per-job makespans for a plan.  If
+       a p95 cost function is given, the pessimistic makespans are included
+       as well."""
+    report = {'jobs': [], 'makespan': 0.0, 'makespan_p95': 0.0, 'total_work': 0.0}
+    for j in jobs:
+        slots = [sum(cost(t) for t in b) for b in j]
+        makespan = max(slots) if slots else 0.0
+        jreport = {
+            'slots': slots,
+            'makespan': makespan,
+            # how much of the job's allocation is spent waiting for the slowest slot.
+            'idle': sum(makespan - s for s in slots),
+        }
+        if cost_p95 is not None:
+            jreport['slots_p95'] = [sum(cost_p95(t) for t in b) for b in j]
+            jreport['makespan_p95'] = max(jreport['slots_p95']) if j else 0.0
+            report['makespan_p95'] = max(report['makespan_p95'], jreport['makespan_p95'])
+        report['jobs'].append(jreport)
+        report['makespan'] = max(report['makespan'], makespan)
+        report['total_work'] += sum(slots)
+    return report
@@ -5,39 +5,147 @@ from pathlib import Path
 import time
 import os
 import logging
+import fcntl
+
+# the fields which are projected out of squeue and sacct.  The keys are the
+# names used in the job records, which mostly match squeue's json output.
+SQUEUE_FIELDS = {
+    'job_id': '%i',
+    'name': '%j',
+    'job_state': '%T',
+    'partition': '%P',
+    'time_used': '%M',
+    'time_limit': '%l',
+    'submit_time': '%V',
+    'start_time': '%S',
+    'reason': '%R',
+    'cpus': '%C',
+    'memory': '%m',
+    'gres': '%b',
+}
+
+SACCT_FIELDS = {
+    'job_id': 'JobID',
+    'name': 'JobName',
+    'job_state': 'State',
+    'partition': 'Partition',
+    'time_used': 'Elapsed',
+    'time_limit': 'Timelimit',
+    'submit_time': 'Submit',
+    'start_time': 'Start',
+    'end_time': 'End',
+    'exit_code': 'ExitCode',
+    'cpus': 'AllocCPUS',
+    'memory': 'ReqMem',
+}
+
+ACCOUNTING_FIELDS = {
+    'job_id': 'JobID',
+    'name': 'JobName',
+    'job_state': 'State',
+    'elapsed': 'Elapsed',
+    'time_limit': 'Timelimit',
+    'total_cpu': 'TotalCPU',
+    'max_rss': 'MaxRSS',
+    'req_mem': 'ReqMem',
+    'cpus': 'AllocCPUS',
+}
+
+TERMINAL_STATES = {'COMPLETED', 'CANCELLED', 'FAILED', 'TIMEOUT', 'NODE_FAIL',
+                   'PREEMPTED', 'BOOT_FAIL', 'DEADLINE', 'OUT_OF_MEMORY'}
+
+
+def _parse_fields(output: str, fields: list[str]):
+    """Parse |-delimited output into records keyed by job id"""
+    res = {}
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        values = line.split("|", len(fields) - 1)
+        rec = dict(zip(fields, [v.strip() for v in values]))
+        res[rec['job_id']] = rec
+    return res
+
+
+def parse_duration(value: str):
+    """Convert a slurm [D-][HH:]MM:SS[.mmm] duration to seconds"""
+    if not value or value in ('UNLIMITED', 'Partition_Limit', 'INVALID'):
+        return None
+    days = 0
+    if "-" in value:
+        d, value = value.split("-", 1)
+        days = int(d)
+    parts = [float(x) for x in value.split(":")]
+    while len(parts) < 3:
+        parts.insert(0, 0)
+    return days * 86400 + parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+
+def parse_memory(value: str):
+    """Convert a slurm memory value like 1234K or 64G (with an optional
+       per-node/per-cpu n or c suffix) to GB"""
+    if not value:
+        return 0
+    value = value.rstrip("nc")
+    scale = {'K': 1 / 1024 ** 2, 'M': 1 / 1024, 'G': 1, 'T': 1024}
+    if value[-1] in scale:
+        return float(value[:-1]) * scale[value[-1]]
+    # plain bytes
+    return float(value) / 1024 ** 3
+
+
+def _id_matches(key: str, jobid):
+    """Check if a job key (<jobid> or <jobid>_<index>) matches a job id or
+       an array job id"""
+    jobid = str(jobid)
+    return key == jobid or key.split("_")[0] == jobid
+
 
 class Slurm:
-    def __init__(self, account: str, batchdir: str):
+    def __init__(self, account: str, batchdir: str, cache_ttl=30, history_days=7, bindir=None):
         self.account = account
         self.batchdir = Path(batchdir)
+        # where the slurm commands live, if not on the path.  Pointing this
+        # at the fake_slurm commands allows for testing without a cluster.
+        self.bindir = Path(bindir) if bindir else None
+        self.cache_ttl = cache_ttl
+        self.history_days = history_days
         self.batchdir.mkdir(exist_ok=True, parents=True)
 
 
-    def submit(self, scriptbody, email, gpu=0, cpu=1, ram=16, job_time="1:00", tag=None):
-        """Submit a new batch job, returning the id"""
-        # create a batch name, directory, and move there.
+    def _cmd(self, name):
+        """Get the path to a slurm command"""
+        return str(self.bindir / name) if self.bindir else name
+
+
+    def _make_job(self, gpu, cpu, tag):
+        """Create a job name and directory and move there"""
         if not tag:
             job_name = f"job-{time.time()}-{gpu}-{cpu}"
         else:
             job_name = f"job-{time.time()}-{tag}-{gpu}-{cpu}"
         job_dir: Path = self.batchdir / job_name
         job_dir.mkdir()
-        here = Path.cwd()
         os.chdir(job_dir)
+        return job_name, job_dir
+
 
-        # build the job script
+    def _build_script(self, job_name, job_dir, scriptbody, email, gpu, cpu, ram, job_time, sbatch_extra=None, stdio_suffix=""):
+        """Build the job script and return the path to it"""
         script = [
             f"#!/bin/bash",
             f"#SBATCH -J {job_name}",
             f"#SBATCH -A {self.account}",
-            f"#SBATCH -o {str(job_dir.absolute())}/stdout.txt",
-            f"#SBATCH -e {str(job_dir.absolute())}/stderr.txt",
+            f"#SBATCH -o {str(job_dir.absolute())}/stdout{stdio_suffix}.txt",
+            f"#SBATCH -e {str(job_dir.absolute())}/stderr{stdio_suffix}.txt",
             f'#SBATCH -t {job_time}',
             f"#SBATCH --mail-type=ALL",
             f"#SBATCH --mail-user={email}",
             f"#SBATCH --mincpus={cpu}",
             f"#SBATCH --mem {ram}G",
         ]
+        if sbatch_extra:
+            script.extend([f"#SBATCH {x}" for x in sbatch_extra])
 
         # if a GPU is requested, add the GPU parameters.
         if gpu > 0:
@@ -63,81 +171,339 @@ class Slurm:
 
         # capture the return code
         script.extend([
-            "echo $? >> returncode.txt"
+            f"echo $? >> returncode{stdio_suffix.replace('%a', '$SLURM_ARRAY_TASK_ID')}.txt"
         ])
 
         # write the script
         with open(job_dir / "script.sh", "w") as f:
             f.write("\n".join(script) + "\n")
         (job_dir / "script.sh").chmod(0o755)
+        return job_dir / "script.sh"
+
+
+    def _sbatch(self, job_dir: Path, script: Path):
+        """Submit the script to slurm, returning the job id"""
+        p = subprocess.run([self._cmd('sbatch'), str(script.absolute())],
+                            stdout=subprocess.PIPE, encoding='utf-8')
+        output = p.stdout.strip()
+        #logging.info(output)
+        jobid = int(p.stdout.strip().split()[-1])
+        with open(job_dir / "slurm_job.txt", "w") as f:
+            f.write(f"{jobid}\n")
+        # the snapshot doesn't have the new job
+        self._invalidate_snapshot()
+        return jobid
+
+
+    def submit(self, scriptbody, email, gpu=0, cpu=1, ram=16, job_time="1:00", tag=None, metadata=None):
+        """Submit a new batch job, returning the id.  The metadata is saved
+           in the job directory for the accounting later."""
+        # create a batch name, directory, and move there.
+        job_name, job_dir = self._make_job(gpu, cpu, tag)
+        if metadata is not None:
+            with open(job_dir / "metadata.json", "w") as f:
+                json.dump(metadata, f, indent=2)
+        script = self._build_script(job_name, job_dir, scriptbody, email, gpu, cpu, ram, job_time)
 
         # submit the job to slurm
         if True:
-            p = subprocess.run(['sbatch', str((job_dir / "script.sh").absolute())],
-                                stdout=subprocess.PIPE, encoding='utf-8')
-            output = p.stdout.strip()
-            #logging.info(output)
-            jobid = int(p.stdout.strip().split()[-1])
-            with open(job_dir / "slurm_job.txt", "w") as f:
-                f.write(f"{jobid}\n")
-            return jobid
+            return self._sbatch(job_dir, script)
         else:
             return job_dir.name
 
 
-    def get_job_info(self, jobid=None, jobname=None, active=True):
-        """Get job information for all jobs with this account, filtered by
-           jobid or jobname"""
-        p = subprocess.run(['squeue', '-A', self.account, '--json'],
-                           stdout=subprocess.PIPE, encoding='utf-8')        
+    def submit_array(self, scriptbody, payloads: list[str], email, gpu=0, cpu=1, ram=16, job_time="1:00", tag=None, throttle=None,
+                     metadata=None):
+        """Submit a job array with one task per payload, returning the
+           array task ids (<jobid>_<index>) in payload order.
+
+           Each payload is written to payload-<index>.txt in the job directory
+           and the script body can find the one for its task in $PAYLOAD.  Every
+           task uses the same resources.  If throttle is given, no more than
+           that many tasks will run at the same time.  The metadata is a list
+           with an entry for each payload."""
+        job_name, job_dir = self._make_job(gpu, cpu, tag)
+        if metadata is not None:
+            with open(job_dir / "metadata.json", "w") as f:
+                json.dump({str(n): m for n, m in enumerate(metadata)}, f, indent=2)
+        for n, payload in enumerate(payloads):
+            with open(job_dir / f"payload-{n}.txt", "w") as f:
+                f.write(payload)
+        array = f"0-{len(payloads) - 1}" + (f"%{throttle}" if throttle else "")
+        scriptbody = f"PAYLOAD={job_dir!s}/payload-$SLURM_ARRAY_TASK_ID.txt\n" + scriptbody
+        script = self._build_script(job_name, job_dir, scriptbody, email, gpu, cpu, ram, job_time,
+                                    sbatch_extra=[f"--array={array}"], stdio_suffix="-%a")
+        jobid = self._sbatch(job_dir, script)
+        taskids = [f"{jobid}_{n}" for n in range(len(payloads))]
+        with open(job_dir / "array_map.json", "w") as f:
+            json.dump({t: f"payload-{n}.txt" for n, t in enumerate(taskids)}, f, indent=2)
+        return taskids
+
+
+    def job_dir(self, jobid):
+        """Find the directory of a job (or array task) from its id"""
+        base = str(jobid).split("_")[0]
+        for f in self.batchdir.glob("job-*/slurm_job.txt"):
+            if f.read_text().strip() == base:
+                return f.parent
+        return None
+
+
+    def _squeue(self, jobid=None, jobname=None):
+        """Run squeue for our account and return the projected job records
+           keyed by job id, or None if squeue failed.  Array jobs are expanded
+           so every array task has its own record."""
+        cmd = [self._cmd('squeue'), '-A', self.account, '--array', '--noheader',
+               '--format=' + "|".join(SQUEUE_FIELDS.values())]
+        if jobid is not None:
+            cmd.append(f"--jobs={jobid}")
+        if jobname is not None:
+            cmd.append(f"--name={jobname}")
+        p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8')
+        if p.returncode != 0:
+            # asking for a job that has left the queue is an error.
+            logging.debug(f"squeue failed: {p.stderr.strip()}")
+            return None if jobid is None else {}
+        return _parse_fields(p.stdout, list(SQUEUE_FIELDS.keys()))
+
+
+    def _sacct(self, jobid=None, jobname=None):
+        """Get the accounting records for jobs which may have left the queue"""
+        cmd = [self._cmd('sacct'), '-A', self.account, '-X', '--noheader', '--parsable2',
+               '--format=' + ",".join(SACCT_FIELDS.values())]
+        if jobid is not None:
+            cmd.append(f"--jobs={jobid}")
+        else:
+            cmd.append(f"--starttime=now-{self.history_days}days")
+        if jobname is not None:
+            cmd.append(f"--name={jobname}")
+        p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8')
         if p.returncode != 0:
+            logging.debug(f"sacct failed: {p.stderr.strip()}")
             return {}
-        
-        raw = json.loads(p.stdout)
-        res = {}
-        for j in raw['jobs']:
-            if j['account'] == self.account:
-                if j['job_state'] == 'COMPLETED' and active:
-                    continue              
-                if jobid is not None and int(jobid) != j['job_id']:
-                    continue
-                if jobname is not None and jobname != j['name']:
-                    continue                
-                res[j['job_id']] = j
+        res = _parse_fields(p.stdout, list(SACCT_FIELDS.keys()))
+        for j in res.values():
+            # sacct has things like "CANCELLED by 1234"
+            j['job_state'] = j['job_state'].split()[0] if j['job_state'] else j['job_state']
+        return res
+
+
+    def _snapshot(self, newer_than=0):
+        """Return the account-wide queue snapshot, refreshing it if it's
+           older than the cache ttl or was taken before newer_than.  The
+           snapshot is shared by all of the invocations on this host so only
+           one of them runs squeue."""
+        cache = self.batchdir / ".squeue-cache.json"
+
+        def read_cache():
+            try:
+                with open(cache) as f:
+                    data = json.load(f)
+                if time.time() - data['time'] < self.cache_ttl and data['time'] >= newer_than:
+                    return data['jobs']
+            except Exception:
+                pass
+            return None
+
+        if (jobs := read_cache()) is not None:
+            return jobs
+        with open(self.batchdir / ".squeue-cache.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # someone else may have refreshed it while we were waiting
+            if (jobs := read_cache()) is not None:
+                return jobs
+            jobs = self._squeue()
+            if jobs is None:
+                return None
+            tmpfile = cache.with_name(f"{cache.name}.{os.getpid()}")
+            with open(tmpfile, "w") as f:
+                json.dump({'time': time.time(), 'jobs': jobs}, f)
+            os.replace(tmpfile, cache)
+        return jobs
+
+
+    def _invalidate_snapshot(self):
+        """Throw away the snapshot after we've changed the queue"""
+        (self.batchdir / ".squeue-cache.json").unlink(missing_ok=True)
+
+
+    def get_job_info(self, jobid=None, jobname=None, active=True):
+        """Get job information for all jobs with this account, filtered by
+           jobid or jobname.  When active is False, jobs which have already
+           left the queue are included from the accounting records."""
+        if (jobs := self._snapshot() if self.cache_ttl > 0 else None) is not None:
+            res = {k: v for k, v in jobs.items()
+                   if (jobid is None or _id_matches(k, jobid)) and (jobname is None or v['name'] == jobname)}
+            if jobid is not None and not res:
+                # it may have been submitted since the snapshot was taken
+                res = self._squeue(jobid, jobname)
+        elif jobid is not None or jobname is not None:
+            res = self._squeue(jobid, jobname)
+        else:
+            res = self._squeue() or {}
+
+        if not active:
+            for k, v in self._sacct(jobid, jobname).items():
+                if k not in res:
+                    res[k] = v
+        else:
+            res = {k: v for k, v in res.items() if v['job_state'] not in TERMINAL_STATES}
         return res
 
 
+    def active_jobs(self):
+        """The jobs in the queue for this account straight from squeue, for
+           when an old snapshot won't do.  Returns None if squeue failed."""
+        jobs = self._squeue()
+        if jobs is None:
+            return None
+        return {k: v for k, v in jobs.items() if v['job_state'] not in TERMINAL_STATES}
+
+
     def get_job_details(self, jobid):
-        """Get job details"""
-        data = self.get_job_info(jobid)
-        if jobid in data:
-            pass
+        """Get the details for a single job, whether it's queued or not"""
+        return self.get_job_info(jobid, active=False).get(str(jobid), None)
+
 
-        p = subprocess.run(['squeue', '-A', self.account, '--json'],
-                           stdout=subprocess.PIPE, encoding='utf-8')        
+    def get_accounting(self, days=7):
+        """Get the resource usage of our finished jobs from sacct.  The
+           job steps are folded into their job so the MaxRSS is the largest
+           of any step."""
+        p = subprocess.run([self._cmd('sacct'), '-A', self.account, f"--starttime=now-{days}days",
+                            '--noheader', '--parsable2',
+                            '--format=' + ",".join(ACCOUNTING_FIELDS.values())],
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8')
         if p.returncode != 0:
+            logging.warning(f"sacct failed: {p.stderr.strip()}")
             return {}
-        
-        raw = json.loads(p.stdout)
         res = {}
-        for j in raw['jobs']:
-            if j['account'] == self.account:
-                if j['job_state'] == 'COMPLETED' and active:
-                    continue              
-                if jobid is not None and int(jobid) != j['job_id']:
+        for line in p.stdout.splitlines():
+            if not line.strip():
+                continue
+            rec = dict(zip(ACCOUNTING_FIELDS.keys(), line.split("|")))
+            jobid, _, step = rec['job_id'].partition(".")
+            if not step:
+                rec['job_state'] = rec['job_state'].split()[0] if rec['job_state'] else ''
+                rec['max_rss'] = max(parse_memory(rec['max_rss']), res.get(jobid, {}).get('max_rss', 0))
+                res[jobid] = rec
+            else:
+                job = res.setdefault(jobid, {'job_id': jobid, 'max_rss': 0})
+                job['max_rss'] = max(job['max_rss'], parse_memory(rec['max_rss']))
+        return {k: v for k, v in res.items() if 'name' in v}
+
+
+    def backfill_window(self, partition: str):
+        """Find how many nodes in a partition are idle (or partly idle) and
+           how long until the next pending job is expected to start on
+           them.  A job shorter than the window can be backfilled right
+           away.  The window is None if slurm doesn't know."""
+        p = subprocess.run([self._cmd('sinfo'), '-p', partition, '--noheader', '--format=%D|%t'],
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8')
+        idle = 0
+        if p.returncode == 0:
+            for line in p.stdout.splitlines():
+                if "|" not in line:
                     continue
-                if jobname is not None and jobname != j['name']:
-                    continue                
-                res[j['job_id']] = j
-        return res
+                count, state = line.split("|")
+                if state.strip().rstrip("*~#") in ('idle', 'mix'):
+                    idle += int(count)
+        else:
+            logging.debug(f"sinfo failed: {p.stderr.strip()}")
+
+        starts = [x for x in self._pending_starts(partition) or [] if x is not None]
+        window = max(0, min(starts) - time.time()) if starts else None
+        return {'idle_nodes': idle, 'window': window}
+
+
+    def _pending_starts(self, partition: str):
+        """The expected start times of the pending jobs (for everyone) in a
+           partition, None for the ones slurm doesn't have an estimate for.
+           Returns None if squeue failed."""
+        p = subprocess.run([self._cmd('squeue'), '-p', partition, '-t', 'PENDING', '--start',
+                            '--noheader', '--format=%S'],
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8')
+        if p.returncode != 0:
+            logging.debug(f"squeue failed: {p.stderr.strip()}")
+            return None
+        starts = []
+        for line in p.stdout.splitlines():
+            if not line.strip():
+                continue
+            try:
+                starts.append(time.mktime(time.strptime(line.strip(), "%Y-%m-%dT%H:%M:%S")))
+            except ValueError:
+                # N/A when there's no estimate
+                starts.append(None)
+        return starts
+
+
+    def queue_backlog(self, partition: str):
+        """Get the number of pending jobs (for everyone) in a partition, and
+           how long until the last of them is expected to start, if slurm
+           has an estimate"""
+        starts = self._pending_starts(partition)
+        if starts is None:
+            return {'pending': 0, 'wait': None}
+        known = [x for x in starts if x is not None]
+        return {'pending': len(starts), 'wait': max(0, max(known) - time.time()) if known else None}
+
 
+    def wait_jobs(self, jobids: list[str], interval=10, max_interval=300, backoff=1.5, timeout=None):
+        """Wait for jobs to leave the queue, yielding a {job_id, job_state}
+           event for each one as it finishes.  Each poll is a single squeue
+           for the whole account (shared through the snapshot cache) and a
+           single sacct for the jobs which have just finished, no matter how
+           many jobs are being waited on.  The poll interval grows by the
+           backoff factor while nothing is happening and goes back to the
+           start whenever a job finishes.  A job has only finished when sacct
+           says so:  one that has just been submitted may not be in the queue
+           yet, and sacct can lag behind the queue."""
+        waiting = {str(x) for x in jobids}
+        # polls where a job was in neither the queue nor sacct
+        missing = {}
+        delay = interval
+        started = time.time()
+        deadline = started + timeout if timeout else None
+        while waiting:
+            # a snapshot from before we started may not have the jobs
+            jobs = self._snapshot(newer_than=started) if self.cache_ttl > 0 else None
+            if jobs is None:
+                jobs = self._squeue()
+            if jobs is None:
+                logging.warning("Cannot get the queue, will try again")
+            else:
+                active = [k for k, v in jobs.items() if v['job_state'] not in TERMINAL_STATES]
+                done = sorted(j for j in waiting if not any(_id_matches(k, j) for k in active))
+                if done:
+                    history = self._sacct(",".join(done))
+                    for j in done:
+                        states = [v['job_state'] for k, v in history.items() if _id_matches(k, j)]
+                        if not states:
+                            # give up on it if sacct never hears of it
+                            missing[j] = missing.get(j, 0) + 1
+                            if missing[j] < 5:
+                                continue
+                            state = 'UNKNOWN'
+                        elif any(s not in TERMINAL_STATES for s in states):
+                            continue
+                        else:
+                            # an array job is only as good as its worst task
+                            state = next((s for s in states if s != 'COMPLETED'), states[0])
+                        yield {'job_id': j, 'job_state': state}
+                        waiting.discard(j)
+                        delay = interval
+            if not waiting or deadline is not None and time.time() >= deadline:
+                return
+            time.sleep(delay if deadline is None else min(delay, max(0, deadline - time.time())))
+            delay = min(delay * backoff, max_interval)
 
 
     def cancel_job(self, jobid: str):
         """Cancel a job"""
-        p = subprocess.run(['scancel', '-A', self.account, jobid],
+        p = subprocess.run([self._cmd('scancel'), '-A', self.account, jobid],
                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
                            encoding='utf-8')
+        self._invalidate_snapshot()
         return p.returncode == 0
     
 
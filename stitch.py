@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# Stitch the partial transcripts of split media back together.
+#
+# When hpc_service splits a long file, each part is transcribed separately
+# and written to <outfile>.partNNN with the segment timestamps already on the
+# timeline of the whole file.  The parts overlap a little so the overlap is
+# cut at its midpoint:  words that start before the midpoint come from the
+# earlier part and the rest from the later one, and a segment which crosses
+# the midpoint is trimmed to the words on its side.
+import argparse
+import json
+import logging
+from pathlib import Path
+import re
+
+PART_RE = re.compile(r"^(.+)\.part(\d{3})$")
+
+
+def trim_segment(seg: dict, lo: float, hi: float):
+    """Return the part of a segment whose words start in [lo, hi), or None
+       if there isn't any.  Segments without words are kept or dropped by
+       their start."""
+    def inside(start):
+        return (lo is None or start >= lo) and (hi is None or start < hi)
+
+    words = seg.get('words')
+    if not words:
+        return seg if inside(seg['start']) else None
+    kept = [w for w in words if inside(w['start'])]
+    if len(kept) == len(words):
+        return seg
+    if not kept:
+        return None
+    seg = dict(seg)
+    # the tokens are for the whole segment, so they don't match anymore
+    seg.pop('tokens', None)
+    seg.update({'start': kept[0]['start'], 'end': kept[-1]['end'], 'words': kept,
+                'text': ''.join(w['word'] for w in kept)})
+    return seg
+
+
+def stitch_transcripts(parts: list[dict]):
+    """Combine the partial transcripts into one transcript"""
+    parts = sorted(parts, key=lambda x: x['_job']['part']['index'])
+    res = {
+        'text': '',
+        'segments': [],
+        'language': parts[0].get('language'),
+    }
+    if 'faster_whisper_info' in parts[0]:
+        res['faster_whisper_info'] = parts[0]['faster_whisper_info']
+
+    for n, p in enumerate(parts):
+        lo = None
+        hi = None
+        if n > 0:
+            prev = parts[n - 1]['_job']['part']
+            lo = (p['_job']['part']['start'] + prev['end']) / 2
+        if n < len(parts) - 1:
+            nxt = parts[n + 1]['_job']['part']
+            hi = (nxt['start'] + p['_job']['part']['end']) / 2
+        for seg in p['segments']:
+            seg = trim_segment(seg, lo, hi)
+            if seg is None:
+                continue
+            seg['id'] = len(res['segments'])
+            res['segments'].append(seg)
+            res['text'] += seg['text']
+
+    job = dict(parts[0]['_job'])
+    part = job.pop('part')
+    job.update({
+        'runtime': sum(p['_job']['runtime'] for p in parts),
+        'media_duration': part['media_duration'],
+        'outfile': part['outfile'],
+        'parts': [p['_job'] for p in parts],
+    })
+    res['_job'] = job
+    return res
+
+
+def find_complete_parts(directory: Path):
+    """Return a dict of outfile -> part files for the split transcripts in
+       a directory where all of the parts are present"""
+    groups = {}
+    for f in directory.glob("*.part[0-9][0-9][0-9]"):
+        m = PART_RE.match(str(f))
+        groups.setdefault(m.group(1), []).append(f)
+
+    res = {}
+    for outfile, files in groups.items():
+        with open(files[0]) as f:
+            count = json.load(f)['_job']['part']['count']
+        if len(files) == count:
+            res[outfile] = sorted(files)
+        else:
+            logging.debug(f"{outfile} has {len(files)} of {count} parts")
+    return res
+
+
+def stitch_directory(directory: Path, keep=False):
+    """Stitch all of the complete partial transcripts in a directory,
+       returning the list of transcripts created"""
+    done = []
+    for outfile, files in find_complete_parts(directory).items():
+        parts = []
+        for pf in files:
+            with open(pf) as f:
+                parts.append(json.load(f))
+        with open(outfile, "w") as f:
+            json.dump(stitch_transcripts(parts), f, indent=4)
+        logging.info(f"Stitched {len(files)} parts into {outfile}")
+        if not keep:
+            for pf in files:
+                pf.unlink()
+        done.append(outfile)
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--debug", default=False, action="store_true", help="Turn on debugging")
+    parser.add_argument("--keep", default=False, action="store_true", help="Keep the part files")
+    parser.add_argument("outdir", type=Path, help="Transcript directory")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format="%(asctime)s [%(process)d:%(filename)s:%(lineno)d] [%(levelname)s] %(message)s")
+    stitch_directory(args.outdir, keep=args.keep)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# A task queue in a directory on the shared filesystem.
+#
+# Tasks are json files in pending/ which are named so that sorting them by
+# name gives the longest tasks first.  A worker claims a task by renaming it
+# into claimed/ with its owner id in front of the name, which is atomic on
+# the same filesystem, so only one worker can ever get a task.  Finished
+# tasks are moved to done/ or failed/.  An idle worker may also speculate on
+# a claimed task that is running long, which is recorded in speculative/ so
+# only one extra copy of it is ever run.
+import json
+import logging
+import os
+from pathlib import Path
+import time
+import itertools
+
+_serial = itertools.count()
+
+
+class TaskQueue:
+    def __init__(self, path, listing_ttl=60):
+        self.path = Path(path)
+        # listing a big pending directory on the shared filesystem for every
+        # claim is a lot of metadata traffic, so the names are kept for a
+        # while and the ones someone else took are just skipped.
+        self.listing_ttl = listing_ttl
+        self._listing = None
+        self._listed = 0
+        for d in ('pending', 'claimed', 'done', 'failed', 'speculative'):
+            (self.path / d).mkdir(exist_ok=True, parents=True)
+
+
+    def enqueue(self, task: dict, cost: float):
+        """Add a task with a predicted cost in seconds"""
+        # the longest tasks sort first
+        name = f"{max(0, 10**9 - int(cost)):010d}-{time.time():.6f}-{os.getpid()}-{next(_serial)}.json"
+        tmpfile = self.path / f".{name}"
+        with open(tmpfile, "w") as f:
+            json.dump({'cost': cost, 'task': task}, f)
+        tmpfile.rename(self.path / "pending" / name)
+        return name
+
+
+    def pending(self):
+        """The names of the pending tasks, longest first"""
+        return sorted(x.name for x in (self.path / "pending").glob("*.json"))
+
+
+    def pending_work(self):
+        """The total predicted cost of the pending tasks"""
+        return sum(10**9 - int(x.split("-")[0]) for x in self.pending())
+
+
+    def claim(self, owner: str, max_cost=None):
+        """Claim the longest pending task that fits in max_cost.  Returns
+           the claim name and the task, or (None, None) if there isn't one."""
+        fresh = self._listing is None or time.time() - self._listed > self.listing_ttl
+        while True:
+            if fresh:
+                self._listing = self.pending()
+                self._listed = time.time()
+            for name in list(self._listing):
+                if max_cost is not None and 10**9 - int(name.split("-")[0]) > max_cost:
+                    continue
+                self._listing.remove(name)
+                claim = f"{owner}--{name}"
+                try:
+                    (self.path / "pending" / name).rename(self.path / "claimed" / claim)
+                except FileNotFoundError:
+                    # someone else got it first
+                    continue
+                # the rename keeps the mtime, which becomes the claim time
+                os.utime(self.path / "claimed" / claim)
+                with open(self.path / "claimed" / claim) as f:
+                    return claim, json.load(f)
+            if fresh:
+                return None, None
+            # there may be new tasks since the listing
+            fresh = True
+
+
+    def speculate(self, owner: str, slow=1.5, max_cost=None):
+        """Take a speculative copy of the claimed task of another owner which
+           is the furthest past slow times its predicted cost and fits in
+           max_cost.  The claim stays with the original owner and whichever
+           copy finishes first moves it.  Returns the claim name and the task,
+           or (None, None) if there isn't one."""
+        now = time.time()
+        overdue = []
+        for f in (self.path / "claimed").glob("*--*.json"):
+            if f.name.startswith(f"{owner}--") or (self.path / "speculative" / f.name).exists():
+                continue
+            cost = 10**9 - int(f.name.split("--", 1)[1].split("-")[0])
+            if max_cost is not None and cost > max_cost:
+                continue
+            try:
+                late = now - f.stat().st_mtime - slow * cost
+            except FileNotFoundError:
+                continue
+            if late > 0:
+                overdue.append((late, f.name))
+        for _, claim in sorted(overdue, reverse=True):
+            try:
+                # only one speculative copy per task
+                os.close(os.open(self.path / "speculative" / claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                continue
+            try:
+                with open(self.path / "claimed" / claim) as f:
+                    return claim, json.load(f)
+            except FileNotFoundError:
+                # it finished while we were looking
+                continue
+        return None, None
+
+
+    def finish(self, claim: str, success=True):
+        """Move a claimed task to done or failed"""
+        try:
+            (self.path / "claimed" / claim).rename(self.path / ("done" if success else "failed") / claim)
+        except FileNotFoundError:
+            # it was requeued out from under us, so someone may redo it, or
+            # a speculative copy got there first.
+            logging.warning(f"Claim {claim} was no longer held when it finished")
+
+
+    def requeue(self, owner: str):
+        """Put the tasks claimed by an owner back in the queue"""
+        count = 0
+        for f in (self.path / "claimed").glob(f"{owner}--*"):
+            try:
+                f.rename(self.path / "pending" / f.name.split("--", 1)[1])
+                count += 1
+            except FileNotFoundError:
+                pass
+        if count:
+            logging.info(f"Requeued {count} tasks claimed by {owner}")
+        return count
+
+
+    def owners(self):
+        """The owners of the claimed tasks"""
+        return {x.name.split("--", 1)[0] for x in (self.path / "claimed").glob("*--*")}
+
+
+    def claimed(self):
+        """The names of the claimed tasks"""
+        return sorted(x.name for x in (self.path / "claimed").glob("*--*.json"))
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# Parallel, resumable sftp downloads.
+#
+# A single sftp read loop is limited by the round trip time and the channel
+# window, so big files are split into chunks that are read concurrently over
+# several sftp channels on the same ssh connection.  Each chunk is a pipelined
+# readv, and the channels have a big window so they can keep data in flight.
+# The chunks are written into <localfile>.part and the finished ones are
+# recorded in <localfile>.part.json, so an interrupted download picks up
+# where it left off if the remote file hasn't changed.  If the connection
+# drops, it's made again with the connect function, when there is one.
+import argparse
+import concurrent.futures
+import getpass
+import hashlib
+import json
+import logging
+import os
+import queue
+from pathlib import Path
+import threading
+import time
+
+import paramiko
+
+# bigger than paramiko's 2M default so a channel can keep more in flight
+WINDOW_SIZE = 64 * 1024 * 1024
+MAX_PACKET_SIZE = 32 * 1024
+
+
+class Downloader:
+    def __init__(self, sftp: paramiko.SFTPClient, channels=4, chunk_size=32 * 1024 * 1024, retries=3, connect=None):
+        """Download with up to channels concurrent sftp channels on the
+           same connection as sftp.  connect makes a new connection and
+           returns its SFTPClient."""
+        self.sftp = sftp
+        self.transport = sftp.get_channel().get_transport()
+        self.channels = channels
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.connect = connect
+        self.lock = threading.Lock()
+        # idle sftp channels, which are reused across downloads
+        self.idle = queue.SimpleQueue()
+
+
+    def reconnect(self, transport=None):
+        """Make the connection again if it has dropped, unless another
+           thread has already done it"""
+        with self.lock:
+            if transport not in (None, self.transport) or self.transport.is_active():
+                return
+            if self.connect is None:
+                raise IOError("The connection has dropped")
+            logging.warning("The connection has dropped, connecting again")
+            self.sftp = self.connect()
+            self.transport = self.sftp.get_channel().get_transport()
+            # the channels on the old connection are gone too
+            self.idle = queue.SimpleQueue()
+
+
+    def _read_chunk(self, remotefile: str, fd: int, offset: int, length: int):
+        """Read a range of the remote file into the same range of the local
+           file, with a new channel if it fails"""
+        for attempt in range(self.retries + 1):
+            transport = self.transport
+            client = None
+            try:
+                try:
+                    client = self.idle.get_nowait()
+                except queue.Empty:
+                    client = paramiko.SFTPClient.from_transport(transport, window_size=WINDOW_SIZE,
+                                                                max_packet_size=MAX_PACKET_SIZE)
+                with client.open(remotefile, "rb") as f:
+                    pos = offset
+                    for data in f.readv([(offset, length)]):
+                        os.pwrite(fd, data, pos)
+                        pos += len(data)
+                    if pos != offset + length:
+                        raise IOError(f"Short read at {offset}: {pos - offset} of {length} bytes")
+                self.idle.put(client)
+                return
+            except Exception as e:
+                try:
+                    if client is not None:
+                        client.close()
+                except Exception:
+                    pass
+                if attempt == self.retries:
+                    raise
+                logging.warning(f"Reading {remotefile} at {offset} failed, trying again: {e}")
+                time.sleep(2 ** attempt)
+                if not transport.is_active():
+                    self.reconnect(transport)
+
+
+    def download(self, remotefile: str, localfile, sha256=None):
+        """Download a file, resuming a previous partial download if there is
+           one.  If sha256 is given, the result is checked against it.
+           Returns the number of bytes transferred."""
+        localfile = Path(localfile)
+        partfile = localfile.with_name(localfile.name + ".part")
+        statefile = localfile.with_name(localfile.name + ".part.json")
+        st = self.sftp.stat(remotefile)
+        chunks = [(off, min(self.chunk_size, st.st_size - off)) for off in range(0, st.st_size, self.chunk_size)]
+
+        # only resume if it's the same file and was chunked the same way
+        done = set()
+        ident = {'size': st.st_size, 'mtime': st.st_mtime, 'chunk_size': self.chunk_size}
+        if statefile.exists() and partfile.exists():
+            with open(statefile) as f:
+                state = json.load(f)
+            if all(state.get(k) == v for k, v in ident.items()):
+                done = set(state['done'])
+                logging.info(f"Resuming {remotefile} with {len(done)} of {len(chunks)} chunks done")
+
+        todo = [c for c in chunks if c[0] not in done]
+        start = time.time()
+        lock = threading.Lock()
+        fd = os.open(partfile, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, st.st_size)
+
+            def fetch(chunk):
+                self._read_chunk(remotefile, fd, *chunk)
+                with lock:
+                    done.add(chunk[0])
+                    tmpfile = statefile.with_name(statefile.name + ".tmp")
+                    with open(tmpfile, "w") as f:
+                        json.dump(dict(ident, done=sorted(done)), f)
+                    os.replace(tmpfile, statefile)
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(self.channels, len(todo)))) as executor:
+                for f in [executor.submit(fetch, c) for c in todo]:
+                    f.result()
+        finally:
+            os.close(fd)
+
+        if sha256 is not None:
+            actual = file_sha256(partfile)
+            if actual != sha256:
+                # none of it can be trusted
+                partfile.unlink()
+                statefile.unlink(missing_ok=True)
+                raise IOError(f"Checksum mismatch for {remotefile}: expected {sha256}, got {actual}")
+        os.replace(partfile, localfile)
+        statefile.unlink(missing_ok=True)
+
+        elapsed = time.time() - start
+        transferred = sum(c[1] for c in todo)
+        logging.info(f"Downloaded {remotefile}: {transferred / 1024 ** 2:0.1f}MB in {elapsed:0.1f}s "
+                     f"({transferred / 1024 ** 2 / max(elapsed, 0.001):0.1f}MB/s over {min(self.channels, len(todo))} channels"
+                     f"{', resumed' if len(todo) < len(chunks) else ''})")
+        return transferred
+
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def file_sha256(filename):
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--debug", default=False, action="store_true", help="Turn on debugging")
+    parser.add_argument("--user", default=getpass.getuser(), help="Remote user")
+    parser.add_argument("--keyfile", type=str, default=None, help="Private key file")
+    parser.add_argument("--channels", type=int, default=4, help="Concurrent sftp channels")
+    parser.add_argument("--chunk-size", type=int, default=32, help="Chunk size in MB")
+    parser.add_argument("--sha256", type=str, default=None, help="Expected checksum")
+    parser.add_argument("remote", help="host:path")
+    parser.add_argument("localfile", type=Path, help="Local file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                        format="%(asctime)s [%(process)d:%(filename)s:%(lineno)d] [%(levelname)s] %(message)s")
+
+    host, remotefile = args.remote.split(":", 1)
+    connections = []
+
+    def connect():
+        ssh = paramiko.SSHClient()
+        ssh.load_system_host_keys()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy)
+        ssh.connect(host, username=args.user, key_filename=args.keyfile)
+        connections.append(ssh)
+        return ssh.open_sftp()
+
+    downloader = Downloader(connect(), channels=args.channels, chunk_size=args.chunk_size * 1024 * 1024,
+                            connect=connect)
+    downloader.download(remotefile, args.localfile, args.sha256)
+    downloader.close()
+    for ssh in connections:
+        ssh.close()
+
+
+if __name__ == "__main__":
+    main()